@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Checks the cold start of segmate against an import time budget. The check fails
+if importing segmate.main takes longer than the budget, or if any of the heavy
+modules, which are only imported on first use, is imported at startup.
+
+Usage: python check-startup.py [budget in seconds]
+"""
+
+import subprocess
+import sys
+
+
+IMPORT_BUDGET_SECONDS = 1.5
+
+DEFERRED_MODULES = [
+    "torch",
+    "matplotlib",
+    "scipy.ndimage",
+    "skimage.filters",
+    "skimage.morphology",
+    "skimage.measure"
+]
+
+
+def measure_imports():
+    # Every line of the report reads: 'import time: self [us] | cumulative | name',
+    # nested imports are indented below the module that imported them
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", "import segmate.main"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        print(process.stderr)
+        sys.exit("Importing segmate.main failed.")
+
+    cumulative = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, total, name = line[len("import time:"):].split("|")
+        cumulative[name.strip()] = int(total) / 1e6
+    return cumulative
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else IMPORT_BUDGET_SECONDS
+    cumulative = measure_imports()
+    total = cumulative.get("segmate.main", 0.0)
+    eager = [name for name in DEFERRED_MODULES if name in cumulative]
+
+    print("Importing segmate.main took {0:.3f}s (budget {1:.3f}s).".format(total, budget))
+    for name in eager:
+        print("'{0}' is imported at startup ({1:.3f}s).".format(name, cumulative[name]))
+    if total > budget or eager:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
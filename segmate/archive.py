@@ -0,0 +1,184 @@
+from contextlib import contextmanager
+import mmap
+import os
+from pathlib import Path
+import struct
+import threading
+import zipfile
+import zlib
+
+
+class ProjectArchive:
+    """
+    Read access to the data files of a project archive without extracting it.
+    Members stored without compression are read straight from a memory map of
+    the archive. Files in the overlay directory shadow the archive member with
+    the same name, this is where edited files are written to until the project
+    is saved again.
+    """
+
+    def __init__(self, archive_path, overlay_root):
+        self.path = Path(archive_path)
+        self.overlay_root = Path(overlay_root)
+        # Guards the zip file object and the memory map, both are replaced whenever
+        # the archive is reopened after a save, while other threads may be reading
+        self._lock = threading.RLock()
+        self._zipf = None
+        self._file = None
+        self._mmap = None
+        self._members = {}
+        self.garbage_bytes = 0
+
+    @property
+    def exists(self):
+        return self._zipf is not None
+
+    @property
+    def size(self):
+        return len(self._mmap) if self._mmap is not None else 0
+
+    @property
+    def central_directory_offset(self):
+        # Appended members are written from here on
+        return self._zipf.start_dir if self._zipf is not None else 0
+
+    def open(self):
+        with self._lock:
+            self.close()
+            if not self.path.is_file():
+                return
+            self._zipf = zipfile.ZipFile(self.path, mode="r")
+            # Saving appends new versions of modified members, the last one wins and
+            # earlier versions are dead space until the archive is compacted
+            for info in self._zipf.infolist():
+                if info.filename in self._members:
+                    previous = self._members[info.filename]
+                    self.garbage_bytes += 30 + len(previous.filename) + previous.compress_size
+                self._members[info.filename] = info
+            self._file = open(self.path, "rb")
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._file.close()
+                self._zipf.close()
+            self._zipf, self._file, self._mmap = None, None, None
+            self._members = {}
+            self.garbage_bytes = 0
+
+    @contextmanager
+    def suspended(self):
+        # Closes the archive while the file is written, readers wait until it is
+        # reopened instead of failing on a closed or half written archive
+        with self._lock:
+            self.close()
+            try:
+                yield
+            finally:
+                self.open()
+
+    def member_name(self, folder, name):
+        return "data/{0}/{1}".format(folder, name)
+
+    def members(self):
+        with self._lock:
+            return list(self._members.keys())
+
+    def files(self, folder):
+        prefix = "data/{0}/".format(folder)
+        names = {m[len(prefix):] for m in self.members() if m.startswith(prefix)}
+        overlay = self.overlay_root / folder
+        if overlay.is_dir():
+            names.update(p.name for p in overlay.iterdir() if p.is_file())
+        return [n for n in names if n and "/" not in n]
+
+    def overlay_path(self, folder, name):
+        path = self.overlay_root / folder / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def is_overlaid(self, folder, name):
+        return (self.overlay_root / folder / name).is_file()
+
+    def read(self, folder, name):
+        overlay = self.overlay_root / folder / name
+        if overlay.is_file():
+            try:
+                return overlay.read_bytes()
+            except FileNotFoundError:
+                # A save moved the file into the archive in the meantime
+                pass
+        return self.read_member(self.member_name(folder, name))
+
+    def read_member(self, member):
+        # Copying a stored member out of the memory map is cheap, so all reads are
+        # serialized; the zip file object shares one file handle anyway
+        with self._lock:
+            info = self._members.get(member)
+            if info is None:
+                raise FileNotFoundError("'{0}' is not part of the archive.".format(member))
+            if info.compress_type == zipfile.ZIP_STORED:
+                start = self.data_offset(info)
+                return self._mmap[start:start + info.file_size]
+            return self._zipf.read(info)
+
+    def checksum(self, folder, name):
+        # Returns the CRC-32 and size of a file, for archive members both are taken
+        # from the central directory without reading any data
+        overlay = self.overlay_root / folder / name
+        if overlay.is_file():
+            data = overlay.read_bytes()
+            return zlib.crc32(data), len(data)
+        with self._lock:
+            info = self._members.get(self.member_name(folder, name))
+        if info is None:
+            raise FileNotFoundError("'{0}/{1}' is not part of the archive.".format(
+                folder, name))
+        return info.CRC, info.file_size
+
+    def copy(self, folder, name, target):
+        # Stored members and overlays are copied by the kernel where possible,
+        # which shares the data blocks on filesystems that support reflinks
+        overlay = self.overlay_root / folder / name
+        with open(target, "wb") as dst:
+            if overlay.is_file():
+                with open(overlay, "rb") as src:
+                    _copy_range(src, dst, 0, overlay.stat().st_size)
+                return
+            with self._lock:
+                info = self._members.get(self.member_name(folder, name))
+                if info is not None and info.compress_type == zipfile.ZIP_STORED:
+                    _copy_range(self._file, dst, self.data_offset(info), info.file_size)
+                    return
+            dst.write(self.read(folder, name))
+
+    def data_offset(self, info):
+        # The local file header has a fixed size of 30 bytes, followed by the file
+        # name and an extra field, whose lengths can differ from the central directory
+        header = self._mmap[info.header_offset:info.header_offset + 30]
+        name_length, extra_length = struct.unpack("<HH", header[26:30])
+        return info.header_offset + 30 + name_length + extra_length
+
+
+def _copy_range(src, dst, offset, count):
+    if hasattr(os, "copy_file_range"):
+        try:
+            while count > 0:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), count, offset)
+                if copied == 0:
+                    break
+                offset += copied
+                count -= copied
+        except OSError:
+            # Not supported by the kernel or across filesystems, copy what is left
+            pass
+    if count > 0:
+        src.seek(offset)
+        while count > 0:
+            chunk = src.read(min(count, 1 << 20))
+            if not chunk:
+                break
+            dst.write(chunk)
+            count -= len(chunk)
@@ -0,0 +1,115 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import importlib
+import multiprocessing
+from os import cpu_count
+
+import imageio as io
+import numpy as np
+
+
+# Operations are looked up by name in the worker processes, so only the name
+# has to be sent along with every job. Functions are given by module and name,
+# the modules are only imported by the workers.
+OPERATIONS = {
+    "fill_holes": ("scipy.ndimage", "binary_fill_holes"),
+    "dilate": ("skimage.morphology", "binary_dilation"),
+    "erode": ("skimage.morphology", "binary_erosion"),
+    "skeletonize": ("skimage.morphology", "skeletonize")
+}
+
+
+def run(store, layer_idx, operation, *, indices=None, iterations=1, progress=None,
+        workers=None):
+    """Apply a morphology operation to a mask layer of many images.
+
+    Every image is decoded, processed and written to disk by a worker process,
+    the main process only hands out jobs and never holds more than a few masks.
+    Unsaved modifications are written first, since workers read from disk.
+
+    Args:
+        store: The DataStore of the project
+        layer_idx: Index of the mask layer to process
+        operation: Name of the operation, a key of OPERATIONS
+        indices: Indices of the images to process, defaults to all images
+        iterations: How often the operation is applied to each mask
+        progress: Called with (processed, total) after every image, processing
+            stops early once it returns False
+        workers: Number of worker processes, defaults to the number of cores
+
+    Returns:
+        List of the indices of all processed images
+
+    Raises:
+        RuntimeError: Processing an image failed, images processed before the
+            failure are written nonetheless
+    """
+    if operation not in OPERATIONS:
+        raise ValueError("Unknown operation '{0}'.".format(operation))
+    if not store.masks[layer_idx]:
+        raise ValueError("Layer '{0}' is not a mask.".format(store.folders[layer_idx]))
+
+    store.save_to_disk()
+    indices = list(range(len(store))) if indices is None else list(indices)
+    workers = workers or cpu_count() or 1
+    processed = []
+
+    # Spawned workers do not inherit the threads and Qt state of the application
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        # Only a few jobs are in flight at any time, so that the encoded
+        # sources of the whole project are never held in memory at once
+        jobs = iter(indices)
+        pending = {}
+        cancelled = False
+        try:
+            while True:
+                while not cancelled and len(pending) < 2 * workers:
+                    idx = next(jobs, None)
+                    if idx is None:
+                        break
+                    future = pool.submit(_process, operation, iterations,
+                        _source(store.mask_source(idx, layer_idx)),
+                        str(store.mask_target(idx, layer_idx)))
+                    pending[future] = idx
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    idx = pending.pop(future)
+                    # The cached entry is outdated, it is decoded again on next access
+                    store.discard(idx)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        raise RuntimeError("Processing image {0} ('{1}') failed: {2}".format(
+                            idx + 1, store.files[idx], e))
+                    processed.append(idx)
+                    if progress is not None and progress(len(processed), len(indices)) is False:
+                        cancelled = True
+        except BaseException:
+            # Jobs that are already running still write their mask
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+            for idx in pending.values():
+                store.discard(idx)
+            raise
+
+    return processed
+
+
+def _source(source):
+    # Archive members are passed as bytes, paths as strings
+    return source if isinstance(source, bytes) else str(source)
+
+
+def _process(operation, iterations, source, target):
+    module, name = OPERATIONS[operation]
+    function = getattr(importlib.import_module(module), name)
+    mask = io.imread(source, as_gray=True) == 255
+    for _ in range(iterations):
+        mask = function(mask)
+    output = np.zeros(mask.shape, dtype=np.uint8)
+    output[mask] = 255
+    io.imwrite(target, output)
@@ -0,0 +1,87 @@
+from collections import OrderedDict
+import threading
+
+
+class ImageCache:
+    """Least recently used cache for decoded images, bounded by the number of
+    bytes held by the cached arrays. Keys contained in 'pinned' are never evicted.
+    All methods are thread-safe, so the cache can be filled by background workers.
+    """
+
+    def __init__(self, max_bytes, *, pinned=None):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._pinned = pinned if pinned is not None else set()
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._nbytes = 0
+        self._lock = threading.RLock()
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def peek(self, key):
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key, value):
+        with self._lock:
+            self.discard(key)
+            self._entries[key] = value
+            self._sizes[key] = sum(array.nbytes for array in value)
+            self._nbytes += self._sizes[key]
+            self.evict()
+
+    def setdefault(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                return self._entries[key]
+            self.put(key, value)
+            return value
+
+    def discard(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return
+            del self._entries[key]
+            self._nbytes -= self._sizes.pop(key)
+
+    def evict(self):
+        with self._lock:
+            if self._nbytes <= self.max_bytes:
+                return
+            for key in list(self._entries.keys()):
+                if self._nbytes <= self.max_bytes:
+                    break
+                if key in self._pinned:
+                    continue
+                self.discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._nbytes = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
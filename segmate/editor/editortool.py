@@ -1,33 +1,226 @@
+import zlib
+
+import numpy as np
 from PySide2.QtCore import Qt
 from PySide2.QtGui import QCursor
 from PySide2.QtWidgets import QUndoCommand
 
+from .. import workers
+from ..tiles import TiledImage
+
+
+# Upper bound for the compressed undo history of one undo stack, the oldest
+# commands are dropped once it is exceeded
+UNDO_MEMORY_LIMIT = 256 * 1024**2
+
 
 class EditorUndoCommand(QUndoCommand):
+    """
+    Instead of two full copies of the canvas, only the bounding box of the pixels
+    that changed is kept, as the compressed XOR of both states. Applying the XOR
+    to one state yields the other one, hence the same delta serves undo and redo.
+    """
 
-    def __init__(self, snapshot, modified, tool):
+    def __init__(self, snapshot, modified, tool, *, origin=None):
         super().__init__()
 
-        self._snapshot = snapshot.copy()
-        self._modified = modified.copy()
         self._tool = tool
+        self._layer = tool.layer_index
+        self._shape = modified.shape if origin is None else tool.canvas.shape
+        self._dtype = modified.dtype
+        self._rect = None
+        self._delta = None
+        self._checksums = None
+        self._full = None
+
+        if snapshot.shape != modified.shape or snapshot.dtype != modified.dtype:
+            # Nothing to diff against, keep both states compressed instead
+            self._full = (_compress(snapshot), _compress(modified))
+        else:
+            self._rect, self._delta, self._checksums = _encode_delta(snapshot, modified)
+            if origin is not None and self._rect is not None:
+                # Both states are regions of the canvas, located at origin
+                (y1, x1), (y2, x2) = self._rect
+                self._rect = [(y1 + origin[0], x1 + origin[1]),
+                    (y2 + origin[0], x2 + origin[1])]
 
         self.undo_triggered = None
         self.redo_triggered = None
+        self.current_canvas = None
+
+    @property
+    def nbytes(self):
+        if self._full is not None:
+            return len(self._full[0][0]) + len(self._full[1][0])
+        return len(self._delta) if self._delta is not None else 0
+
+    def release(self):
+        # Drops the stored difference, the command can no longer be undone
+        self._rect, self._delta, self._full = None, None, None
+        self.setObsolete(True)
 
     def undo(self):
         if self.undo_triggered:
-            self.undo_triggered(self._snapshot.copy())
-            self._tool.notify_dirty()
+            image = self._restore(0)
+            if image is not None:
+                self.undo_triggered(image, self._layer)
+                self._tool.notify_dirty()
 
     def redo(self):
         if self.redo_triggered:
-            self.redo_triggered(self._modified.copy())
-            self._tool.notify_dirty()
+            image = self._restore(1)
+            if image is not None:
+                self.redo_triggered(image, self._layer)
+                self._tool.notify_dirty()
+
+    def _restore(self, state):
+        if self._full is not None:
+            return _decompress(*self._full[state])
+        if self._delta is None or self.current_canvas is None:
+            return None
+
+        canvas = self.current_canvas(self._layer)
+        if canvas is None or canvas.shape != self._shape or canvas.dtype != self._dtype:
+            return None
+
+        if self._rect is None:
+            return canvas.copy()
+
+        (y1, x1), (y2, x2) = self._rect
+        region = np.array(canvas[y1:y2, x1:x2])
+        region_bytes = region.view(np.uint8).reshape(-1)
+        # The delta only restores one state from the other one, a canvas that was
+        # modified since without a new undo command (e.g. by a plugin) is left alone
+        if zlib.crc32(region_bytes) != self._checksums[1 - state]:
+            self._tool.send_status_message(
+                "The image was modified since, '{0}' can not be restored.".format(self.text()))
+            return None
+        delta = np.frombuffer(zlib.decompress(self._delta), dtype=np.uint8)
+        np.bitwise_xor(region_bytes, delta, out=region_bytes)
+        image = canvas.copy()
+        image[y1:y2, x1:x2] = region
+        return image
+
+
+class TileUndoCommand(EditorUndoCommand):
+    """
+    Undo command for tiled layers. The compressed XOR of both states is kept for
+    every tile that was modified and applied to the tiles in place, so the canvas
+    is never copied as a whole.
+    """
+
+    def __init__(self, snapshot, canvas, tool):
+        QUndoCommand.__init__(self)
+
+        self._tool = tool
+        self._layer = tool.layer_index
+        self._canvas = canvas
+        self._deltas = {}
+        self._checksums = {}
+        for key, tile in snapshot.items():
+            before = _as_bytes(np.ascontiguousarray(tile))
+            after = _as_bytes(np.ascontiguousarray(canvas.tile(*key)))
+            self._deltas[key] = zlib.compress(np.bitwise_xor(before, after).tobytes(), 1)
+            self._checksums[key] = (zlib.crc32(before), zlib.crc32(after))
+        # The tiles already hold the modified state, the initial redo on push
+        # must not apply the difference once more
+        self._state = 1
+
+        self.undo_triggered = None
+        self.redo_triggered = None
+        self.current_canvas = None
+
+    @property
+    def nbytes(self):
+        return sum(len(delta) for delta in self._deltas.values())
+
+    def release(self):
+        self._deltas = {}
+        self.setObsolete(True)
+
+    def undo(self):
+        if self._state == 1 and self._apply():
+            self._state = 0
+            if self.undo_triggered:
+                self.undo_triggered(self._canvas, self._layer)
+                self._tool.notify_dirty()
+
+    def redo(self):
+        if self._state == 0 and self._apply():
+            self._state = 1
+            if self.redo_triggered:
+                self.redo_triggered(self._canvas, self._layer)
+                self._tool.notify_dirty()
+
+    def _apply(self):
+        if not self._deltas:
+            return False
+        # Check every tile first, so that a modified tile leaves all of them alone
+        for key, checksums in self._checksums.items():
+            tile = np.ascontiguousarray(self._canvas.tile(*key))
+            if zlib.crc32(_as_bytes(tile)) != checksums[self._state]:
+                self._tool.send_status_message(
+                    "The image was modified since, '{0}' can not be restored.".format(
+                        self.text()))
+                return False
+        for key, data in self._deltas.items():
+            tile = np.ascontiguousarray(self._canvas.tile(*key))
+            delta = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+            restored = np.bitwise_xor(_as_bytes(tile), delta)
+            self._canvas.write(self._canvas.tile_rect(*key)[0],
+                restored.view(tile.dtype).reshape(tile.shape))
+        return True
+
+
+def _as_bytes(array):
+    return array.view(np.uint8).reshape(-1)
+
+
+def _compress(array):
+    array = np.ascontiguousarray(array)
+    return zlib.compress(array.tobytes(), 1), array.shape, array.dtype
+
+
+def _decompress(data, shape, dtype):
+    return np.frombuffer(zlib.decompress(data), dtype=dtype).reshape(shape).copy()
+
+
+def _encode_delta(snapshot, modified):
+    changed = snapshot != modified
+    if changed.ndim > 2:
+        changed = changed.any(axis=tuple(range(2, changed.ndim)))
+    rows = np.flatnonzero(changed.any(axis=1))
+    if len(rows) == 0:
+        return None, b"", None
+    cols = np.flatnonzero(changed.any(axis=0))
+    rect = [(rows[0], cols[0]), (rows[-1] + 1, cols[-1] + 1)]
+
+    (y1, x1), (y2, x2) = rect
+    before = np.ascontiguousarray(snapshot[y1:y2, x1:x2])
+    after = np.ascontiguousarray(modified[y1:y2, x1:x2])
+    delta = np.bitwise_xor(before.view(np.uint8), after.view(np.uint8))
+    checksums = (zlib.crc32(before.view(np.uint8)), zlib.crc32(after.view(np.uint8)))
+    return rect, zlib.compress(delta.tobytes(), 1), checksums
+
+
+def trim_undo_stack(undo_stack, limit=UNDO_MEMORY_LIMIT):
+    """Release the oldest editor commands once the history exceeds the limit."""
+    total = 0
+    for i in reversed(range(undo_stack.count())):
+        command = undo_stack.command(i)
+        if not isinstance(command, EditorUndoCommand):
+            continue
+        total += command.nbytes
+        if total > limit and command.nbytes > 0:
+            command.release()
 
 
 class EditorTool:
 
+    # Tools that can operate on tiled layers (see segmate.tiles) set this, all
+    # other tools do not receive input while a tiled layer is active
+    supports_tiles = False
+
     def __init__(self):
         self._item = None
         self.is_dirty = False
@@ -49,6 +242,15 @@ class EditorTool:
     def layer_name(self):
         return self._item.layer_names[self._item.active]
 
+    @property
+    def canvas_version(self):
+        # Incremented whenever the canvas of the active layer is modified
+        return self._item._versions[self._item.active]
+
+    @property
+    def is_tiled(self):
+        return isinstance(self.canvas, TiledImage)
+
     @property
     def selection_rect(self):
         return self._item.selection_rect
@@ -99,21 +301,50 @@ class EditorTool:
     def on_show_widget(self):
         return None
 
-    def push_undo_snapshot(self, snapshot, modified, *, undo_text=""):
+    def on_batch(self):
+        # Called once per image by the headless runner (see segmate.headless), with
+        # the canvas set to the processed layer. Returns the modified canvas, or
+        # None if nothing changed. Tools that do not override this can not be batched.
+        return None
+
+    def push_undo_snapshot(self, snapshot, modified, *, undo_text="", origin=None):
+        # snapshot and modified may also be regions of the canvas, in which case
+        # origin is their top left corner (y, x) on the canvas
         if self.undo_stack:
-            command = EditorUndoCommand(snapshot, modified, self)
-            command.setText(undo_text)
-            # a undo-command push triggers a redo - so push first, then
-            # register callbacks; this suppresses the signal on initial redo
-            self.undo_stack.push(command)
-            command.undo_triggered = self._item.undo_tool_command
-            command.redo_triggered = self._item.redo_tool_command
+            command = EditorUndoCommand(snapshot, modified, self, origin=origin)
+            self._push_undo_command(command, undo_text)
+
+    def push_tile_undo_snapshot(self, snapshot, *, undo_text=""):
+        # snapshot maps (row, column) of every modified tile to its previous content
+        if self.undo_stack and snapshot:
+            self._push_undo_command(TileUndoCommand(snapshot, self.canvas, self), undo_text)
+
+    def _push_undo_command(self, command, undo_text):
+        command.setText(undo_text)
+        # a undo-command push triggers a redo - so push first, then
+        # register callbacks; this suppresses the signal on initial redo
+        self.undo_stack.push(command)
+        command.undo_triggered = self._item.undo_tool_command
+        command.redo_triggered = self._item.redo_tool_command
+        command.current_canvas = self._item.layer_canvas
+        trim_undo_stack(self.undo_stack)
+
+    def run_in_worker(self, function, *args, callback=None, **kwargs):
+        # function is called in a worker process, hence it has to be defined at the
+        # module level of the plugin. Arrays are passed in shared memory. callback
+        # receives the result on the GUI thread, unless the image was changed since.
+        # Without a running event loop, e.g. in headless runs, both happen right away.
+        return workers.get_pool().submit(function, *args, callback=callback,
+            owner=self._item, **kwargs)
 
     def send_status_message(self, message):
         if self.status_callback:
             self.status_callback(message)
 
-    def notify_dirty(self):
+    def notify_dirty(self, rect=None):
+        # If the tool knows the modified region [(y1, x1), (y2, x2)] only that
+        # part of the layer is converted and repainted
+        self._item.invalidate(self._item.active, rect)
         self._item.image_modified.emit()
 
     def set_cursor(self, name):
@@ -126,7 +357,8 @@ class EditorTool:
         self._item.show_selection = enabled
 
     def set_layer(self, layer_index, image):
-        self._item._layer_data[layer_index] = image
+        self._item._layer_data[layer_index] = self._item._compact(layer_index, image)
+        self._item.invalidate(layer_index)
 
     def get_layers(self, layer_index=None, image_index=None):
         if image_index is not None:
@@ -150,6 +382,8 @@ class EditorTool:
         return self._item._masks[layer_index]
 
     def update(self):
+        # Tools may have changed the canvas in place before requesting a repaint
+        self._item.invalidate(self._item.active)
         self._item.update()
 
     def _on_hide(self):
@@ -1,12 +1,20 @@
+from collections import OrderedDict
+
+import numpy as np
 from PySide2.QtCore import *
 from PySide2.QtWidgets import *
 from PySide2.QtGui import *
 
-from .. import util, plugins
+from .. import util, plugins, workers
+from ..tiles import TiledImage
 from . import tools
 from . import event as tevent
 
 
+# Number of converted tiles of tiled layers that are kept for repainting
+TILE_IMAGE_LIMIT = 512
+
+
 class LayersGraphicsView(QGraphicsObject):
 
     image_modified = Signal()
@@ -25,6 +33,23 @@ class LayersGraphicsView(QGraphicsObject):
         self._opacities = [1.0] * len(self.scene.data_store.folders)
         self._colors = self.scene.data_store.colors
         self._masks = self.scene.data_store.masks
+        self._color_tables = [util.color_table(color) for color in self._colors]
+
+        # Converted QImage per layer, reused until the layer array is replaced or
+        # reported as modified - this makes repainting idle layers free
+        self._qimages = [None] * len(self.scene.data_store.folders)
+        self._versions = [0] * len(self.scene.data_store.folders)
+        self._dirty_rect = None
+        self._dirty_all = False
+
+        # Mip pyramid per layer, used instead of the full resolution image when
+        # zoomed out. Levels of unmodified image layers come from the data store.
+        self._levels = [None] * len(self.scene.data_store.folders)
+        self._load_versions = list(self._versions)
+
+        # Tiled layers are painted tile by tile, only the exposed region is drawn
+        self._tile_images = OrderedDict()
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
 
         self._undo_stack = scene.undo_stack
         self._undo_stack.indexChanged.connect(lambda _: self.update())
@@ -38,10 +63,11 @@ class LayersGraphicsView(QGraphicsObject):
             "morphology_tool": tools.MorphologyTool()
         }
 
-        if plugins.get_plugins():
-            for name, tool in plugins.get_plugins().items():
-                self._tool_box[name] = tool[1]()
+        # Built-in tools report every modification through notify_dirty, plugin
+        # tools may also modify the canvas in place and rely on the repaint
+        self._builtin_tools = list(self._tool_box.values())
 
+        # Plugin tools are created the first time they are selected
         for tool in self._tool_box.values():
             tool._item = self
             tool.on_create()
@@ -52,17 +78,111 @@ class LayersGraphicsView(QGraphicsObject):
         self.tool.on_show()
 
     def load(self, image_idx):
-        self._layer_data = [img.copy() for img in self.scene.data_store[image_idx]]
+        # Results of worker jobs refer to the previous image
+        workers.cancel(self)
+        # Tiled layers are edited in place, their tiles are only copied on write
+        self._layer_data = [img if isinstance(img, TiledImage) else img.copy()
+            for img in self.scene.data_store[image_idx]]
         self.tool.canvas = self._layer_data[self.active]
         self.image_index = image_idx
+        self._tile_images.clear()
+        self.invalidate()
+        self._load_versions = list(self._versions)
         self.update()
 
     def set_opacity(self, layer_idx, value):
         self._opacities[layer_idx] = value
         self.update()
 
+    def invalidate(self, layer_idx=None, rect=None):
+        if layer_idx is not None and self._is_tiled(layer_idx):
+            # Converted tiles are tracked by the version of each tile
+            self._versions[layer_idx] += 1
+            if rect is None:
+                self._dirty_all = True
+            else:
+                self._add_dirty(rect)
+            return
+        if rect is not None and self._patch_image(layer_idx, rect):
+            return
+        indices = range(len(self._versions)) if layer_idx is None else [layer_idx]
+        for i in indices:
+            self._versions[i] += 1
+            self._qimages[i] = None
+            self._levels[i] = None
+        self._dirty_all = True
+
+    def _patch_image(self, layer_idx, rect):
+        # Update a region of the cached image in place, this only works when the
+        # cached image was created from the canvas the tool is working on
+        cached = self._qimages[layer_idx]
+        if cached is None or layer_idx != self.active:
+            return False
+        if cached[0] is not self.tool.canvas or cached[1] != self._versions[layer_idx]:
+            return False
+
+        h, w = cached[0].shape[:2]
+        y1, x1 = max(int(rect[0][0]), 0), max(int(rect[0][1]), 0)
+        y2, x2 = min(int(rect[1][0]), h), min(int(rect[1][1]), w)
+        if y2 <= y1 or x2 <= x1:
+            return True
+
+        region = np.ascontiguousarray(cached[0][y1:y2, x1:x2])
+        color_table = self._color_tables[layer_idx] if self._masks[layer_idx] else None
+        painter = QPainter(cached[2])
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.drawImage(x1, y1, util.to_qimage(region, color_table=color_table))
+        painter.end()
+        self._patch_levels(layer_idx, [(y1, x1), (y2, x2)])
+        self._versions[layer_idx] += 1
+        self._qimages[layer_idx] = (cached[0], self._versions[layer_idx], cached[2])
+        self._add_dirty([(y1, x1), (y2, x2)])
+        return True
+
+    def _add_dirty(self, rect):
+        (y1, x1), (y2, x2) = rect
+        dirty = QRect(int(x1), int(y1), int(x2 - x1), int(y2 - y1))
+        self._dirty_rect = dirty if self._dirty_rect is None else self._dirty_rect.united(dirty)
+
+    def _is_tiled(self, layer_idx):
+        if layer_idx == self.active and self.tool is not None:
+            return isinstance(self.tool.canvas, TiledImage)
+        return isinstance(self._layer_data[layer_idx], TiledImage)
+
+    def _tool_usable(self):
+        # Tools that work on whole arrays can not edit tiled layers
+        return self.tool.supports_tiles or not self._is_tiled(self.active)
+
+    def _patch_levels(self, layer_idx, rect):
+        levels = self._levels[layer_idx]
+        if levels is None or levels[0] is not self.tool.canvas:
+            return
+        if levels[1] != self._versions[layer_idx]:
+            self._levels[layer_idx] = None
+            return
+        pyramid = levels[2]
+        if levels[4]:
+            # Levels shared with the data store must never be modified in place
+            pyramid = [pyramid[0]] + [level.copy() for level in pyramid[1:]]
+        util.pyramid.update(pyramid, rect, mode=self._pyramid_mode(layer_idx))
+        self._levels[layer_idx] = [levels[0], self._versions[layer_idx] + 1, pyramid,
+            [None] * len(pyramid), False]
+
+    def _update_dirty(self):
+        # Repaint only the regions reported by the tool, if nothing was reported
+        # fall back to repainting the whole item
+        if self._dirty_rect is not None and not self._dirty_all:
+            self.update(QRectF(self._dirty_rect))
+        else:
+            if not self._dirty_all and self.tool not in self._builtin_tools:
+                # The canvas may have been changed in place, convert it again
+                self.invalidate(self.active)
+            self.update()
+        self._dirty_rect = None
+        self._dirty_all = False
+
     def set_active(self, layer_idx):
-        self._layer_data[self.active] = self.tool.canvas
+        self._layer_data[self.active] = self._compact(self.active, self.tool.canvas)
         self.active = layer_idx
         self.tool.canvas = self._layer_data[self.active]
         self.tool.color = self._colors[self.active]
@@ -79,7 +199,7 @@ class LayersGraphicsView(QGraphicsObject):
     def data(self):
         result = self.tool.on_finalize()
         if not result is None:
-            self._layer_data[self.active] = result
+            self._layer_data[self.active] = self._compact(self.active, result)
         return self._layer_data
 
     @property
@@ -89,15 +209,17 @@ class LayersGraphicsView(QGraphicsObject):
         return self.tool.on_show_widget()
 
     def change_tool(self, tool, status_callback=None):
-        if tool not in self._tool_box:
+        if tool not in self._tool_box and tool not in plugins.get_plugins():
             raise IndexError("'{0}' is not a valid tool.".format(tool))
+        if tool not in self._tool_box and not self._create_plugin_tool(tool):
+            return False
 
         self.tool._on_hide()
         result = self.tool.on_finalize()
-        if result is not None:
-            result = result.copy()
-        else:
-            result = self._layer_data[self.active].copy()
+        if result is None:
+            result = self._layer_data[self.active]
+        if not isinstance(result, TiledImage):
+            result = self._compact(self.active, result).copy()
 
         self.tool = self._tool_box[tool]
         self.tool.canvas = result
@@ -107,10 +229,38 @@ class LayersGraphicsView(QGraphicsObject):
         self.tool.is_mask = self._masks[self.active]
         self.tool.on_show()
         self.tool_changed.emit()
+        return True
+
+    def _create_plugin_tool(self, name):
+        class_ = plugins.get_plugins()[name].load()
+        if class_ is None:
+            return False
+        try:
+            tool = class_()
+            tool._item = self
+            tool.on_create()
+        except:
+            print("There was an error creating the tool of plugin '{0}'.".format(name))
+            return False
+        self._tool_box[name] = tool
+        return True
+
+    def layer_canvas(self, layer_idx):
+        # Undo commands apply their difference to the current state of a layer,
+        # which requires a pending asynchronous load to be completed first
+        self.scene.wait_for_load()
+        if layer_idx == self.active:
+            return self.tool.canvas
+        return self._layer_data[layer_idx]
 
-    def undo_tool_command(self, image):
+    def undo_tool_command(self, image, layer_idx=None):
+        if layer_idx is not None and layer_idx != self.active:
+            self._layer_data[layer_idx] = image
+            self.invalidate(layer_idx)
+            return
         if self.tool:
             self.tool.canvas = image
+            self.invalidate(self.active)
             if self.tool.status_callback:
                 if self.tool.undo_stack:
                     undo_text = "'{0}'".format(self.tool.undo_stack.undoText())
@@ -118,9 +268,14 @@ class LayersGraphicsView(QGraphicsObject):
                     undo_text = ""
                 self.tool.send_status_message("Undo {0}".format(undo_text))
 
-    def redo_tool_command(self, image):
+    def redo_tool_command(self, image, layer_idx=None):
+        if layer_idx is not None and layer_idx != self.active:
+            self._layer_data[layer_idx] = image
+            self.invalidate(layer_idx)
+            return
         if self.tool:
             self.tool.canvas = image
+            self.invalidate(self.active)
             if self.tool.status_callback:
                 if self.tool.undo_stack:
                     redo_text = "'{0}'".format(self.tool.undo_stack.redoText())
@@ -129,13 +284,102 @@ class LayersGraphicsView(QGraphicsObject):
                 self.tool.send_status_message("Redo {0}".format(redo_text))
 
     def paint(self, painter, option, widget):
+        scale = painter.worldTransform().m11()
         for i, (image, opacity) in enumerate(zip(self._layer_data, self._opacities)):
-            if i == self.active:
+            if i == self.active and self._tool_usable():
                 canvas = self.tool.on_paint()
                 if not canvas is None:
                     image = canvas
             painter.setOpacity(opacity)
-            painter.drawImage(0, 0, util.to_qimage(image))
+            if isinstance(image, TiledImage):
+                self._paint_tiles(painter, i, image, option.exposedRect, scale)
+                continue
+            if scale >= 1.0:
+                painter.drawImage(0, 0, self._layer_image(i, image))
+                continue
+            # Zoomed out, draw the smallest level that still has enough resolution
+            # and let the painter scale it up to the size of the item
+            h, w = image.shape[:2]
+            painter.drawImage(QRectF(0, 0, w, h), self._level_image(i, image, scale))
+
+    def _paint_tiles(self, painter, layer_idx, image, exposed, scale):
+        # Tiles outside of the exposed region are neither read nor converted
+        rect = [(exposed.top(), exposed.left()),
+            (exposed.bottom() + 1, exposed.right() + 1)]
+        level = util.pyramid.level_for_scale(scale, image.tile_size.bit_length())
+        for ty, tx in image.tiles_in(rect):
+            (y1, x1), (y2, x2) = image.tile_rect(ty, tx)
+            painter.drawImage(QRectF(x1, y1, x2 - x1, y2 - y1),
+                self._tile_image(layer_idx, image, ty, tx, level))
+
+    def _tile_image(self, layer_idx, image, ty, tx, level):
+        key = (layer_idx, ty, tx, level)
+        version = image.version(ty, tx)
+        cached = self._tile_images.get(key)
+        if cached is not None and cached[0] is image and cached[1] == version:
+            self._tile_images.move_to_end(key)
+            return cached[2]
+
+        tile = image.tile(ty, tx)
+        for _ in range(level):
+            tile = util.pyramid.downsample(tile, mode=self._pyramid_mode(layer_idx))
+        color_table = self._color_tables[layer_idx] if self._masks[layer_idx] else None
+        qimage = util.to_qimage(np.ascontiguousarray(tile), color_table=color_table)
+        self._tile_images[key] = (image, version, qimage)
+        self._tile_images.move_to_end(key)
+        while len(self._tile_images) > TILE_IMAGE_LIMIT:
+            self._tile_images.popitem(last=False)
+        return qimage
+
+    def _level_image(self, layer_idx, image, scale):
+        levels = self._layer_levels(layer_idx, image)
+        level = util.pyramid.level_for_scale(scale, len(levels[2]))
+        if level == 0:
+            return self._layer_image(layer_idx, image)
+        if levels[3][level] is None:
+            color_table = self._color_tables[layer_idx] if self._masks[layer_idx] else None
+            levels[3][level] = util.to_qimage(levels[2][level], color_table=color_table)
+        return levels[3][level]
+
+    def _layer_levels(self, layer_idx, image):
+        # Entries are [array, version, pyramid, QImage per level, shared]
+        cached = self._levels[layer_idx]
+        version = self._versions[layer_idx]
+        if cached is not None and cached[0] is image and cached[1] == version:
+            return cached
+
+        if not self._masks[layer_idx] and version == self._load_versions[layer_idx]:
+            pyramid = [image] + self.scene.data_store.pyramid(self.image_index, layer_idx)
+            shared = True
+        else:
+            pyramid = util.pyramid.build(image, mode=self._pyramid_mode(layer_idx))
+            shared = False
+        self._levels[layer_idx] = [image, version, pyramid, [None] * len(pyramid), shared]
+        return self._levels[layer_idx]
+
+    def _pyramid_mode(self, layer_idx):
+        # Averaging would let thin structures of masks fade out when zoomed out
+        return "max" if self._masks[layer_idx] else "mean"
+
+    def _layer_image(self, layer_idx, image):
+        cached = self._qimages[layer_idx]
+        version = self._versions[layer_idx]
+        # Compare by identity, the cache holds a reference to the array, so a
+        # replaced array can never be mistaken for the cached one
+        if cached is not None and cached[0] is image and cached[1] == version:
+            return cached[2]
+
+        color_table = self._color_tables[layer_idx] if self._masks[layer_idx] else None
+        qimage = util.to_qimage(image, color_table=color_table)
+        self._qimages[layer_idx] = (image, version, qimage)
+        return qimage
+
+    def _compact(self, layer_idx, image):
+        # Tools (e.g. plugins) may still hand back colored RGBA masks, mask
+        # layers are always stored as compact label maps though
+        if self._masks[layer_idx] and len(image.shape) == 3:
+            return util.mask.compact(image)
+        return image
 
     def boundingRect(self):
         if self._layer_data is None:
@@ -144,28 +388,42 @@ class LayersGraphicsView(QGraphicsObject):
         return QRect(0, 0, x, y)
 
     def mousePressEvent(self, event):
+        if self.tool and self.scene.loading:
+            # The previous image is still shown, edits would be applied to it
+            return
+        if self.tool and not self._tool_usable():
+            self._reject_tool()
+            return
         if self.tool:
             self.tool.on_mouse_pressed(tevent.MouseEvent(event))
-            self.update()
+            self._update_dirty()
             return
         super().mousePressEvent(event)
 
     def mouseReleaseEvent(self, event):
+        if self.tool and (self.scene.loading or not self._tool_usable()):
+            return
         if self.tool:
             self.tool.on_mouse_released(tevent.MouseEvent(event))
-            self.update()
+            self._update_dirty()
             return
         super().mouseReleaseEvent(event)
 
     def mouseMoveEvent(self, event):
+        if self.tool and (self.scene.loading or not self._tool_usable()):
+            return
         if self.tool:
             self.tool.on_mouse_moved(tevent.MouseEvent(event))
-            self.update()
+            self._update_dirty()
             return
         super().mouseMoveEvent(event)
 
     def tabletEvent(self, event):
-        if self.tool is None:
+        if self.tool is None or self.scene.loading:
+            return
+        if not self._tool_usable():
+            if event.type() == QEvent.TabletPress:
+                self._reject_tool()
             return
         if event.type() == QEvent.TabletPress:
             self.tool.on_tablet_pressed(tevent.MouseEvent(event))
@@ -173,14 +431,18 @@ class LayersGraphicsView(QGraphicsObject):
             self.tool.on_tablet_moved(tevent.MouseEvent(event))
         elif event.type() == QEvent.TabletRelease:
             self.tool.on_tablet_released(tevent.MouseEvent(event))
-        self.update()
+        self._update_dirty()
+
+    def _reject_tool(self):
+        self.tool.send_status_message(
+            "This tool can not be used on tiled images, switch to the draw tool...")
 
     def keyPressEvent(self, event):
-        if self.tool is None:
+        if self.tool is None or self.scene.loading or not self._tool_usable():
             return
         self.tool.on_key_pressed(tevent.KeyEvent(event))
 
     def keyReleaseEvent(self, event):
-        if self.tool is None:
+        if self.tool is None or self.scene.loading or not self._tool_usable():
             return
         self.tool.on_key_released(tevent.KeyEvent(event))
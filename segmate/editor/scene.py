@@ -1,3 +1,5 @@
+from functools import partial
+
 from PySide2.QtCore import *
 from PySide2.QtWidgets import *
 from PySide2.QtGui import *
@@ -8,10 +10,12 @@ from .layers import LayersGraphicsView
 class EditorScene(QGraphicsScene):
 
     image_loaded = Signal(int)
+    image_loading = Signal(int)
     opacity_changed = Signal(int, float)
     scene_cleared = Signal()
     image_modified = Signal()
     tool_changed = Signal()
+    _image_ready = Signal(int)
 
     def __init__(self, data_store):
         super().__init__()
@@ -21,11 +25,18 @@ class EditorScene(QGraphicsScene):
         self.undo_stack = QUndoStack()
         self._active_layer = 0
         self._loaded_idx = -1
+        self._pending_idx = None
+        # Emitted from a worker thread, hence delivered through the event loop
+        self._image_ready.connect(self._finish_load)
 
     @property
     def image_count(self):
         return 0 if not self.data_store else len(self.data_store)
 
+    @property
+    def loading(self):
+        return self._pending_idx is not None
+
     @property
     def active_layer(self):
         return self._active_layer
@@ -35,10 +46,51 @@ class EditorScene(QGraphicsScene):
         self.layers.set_active(idx)
         self._active_layer = idx
 
-    def save_to_disk(self):
-        self.data_store.save_to_disk()
+    def save_to_disk(self, progress=None):
+        self.data_store.save_to_disk(progress=progress)
+
+    def load(self, image_idx, *, blocking=True):
+        self._cancel_pending_load()
+        if blocking or self.layers is None or self.data_store.is_cached(image_idx):
+            self._load(image_idx)
+            return
+
+        # Keep showing the previous frame until the new image is decoded; a
+        # request that is superseded before it finished is cancelled
+        self._pending_idx = image_idx
+        self.image_loading.emit(image_idx)
+        future = self.data_store.request(image_idx)
+        future.add_done_callback(partial(self._load_done, image_idx))
+
+    def wait_for_load(self):
+        if self._pending_idx is None:
+            return
+        image_idx = self._pending_idx
+        self._pending_idx = None
+        self._load(image_idx)
+
+    def _load_done(self, image_idx, future):
+        if future.cancelled():
+            return
+        try:
+            self._image_ready.emit(image_idx)
+        except RuntimeError:
+            # The scene was already destroyed while the image was decoded
+            pass
+
+    def _finish_load(self, image_idx):
+        if image_idx != self._pending_idx:
+            return
+        self._pending_idx = None
+        self._load(image_idx)
+
+    def _cancel_pending_load(self):
+        if self._pending_idx is None:
+            return
+        self.data_store.cancel(self._pending_idx)
+        self._pending_idx = None
 
-    def load(self, image_idx):
+    def _load(self, image_idx):
         self._loaded_idx = image_idx
         if self.layers is None:
             self.layers = LayersGraphicsView(self)
@@ -46,6 +98,7 @@ class EditorScene(QGraphicsScene):
             self.layers.tool_changed.connect(self.tool_changed.emit)
             self.addItem(self.layers)
         self.layers.load(image_idx)
+        self.data_store.prefetch(image_idx)
         self.image_loaded.emit(image_idx)
 
     def set_layer_opacity(self, layer_idx, value):
@@ -9,15 +9,15 @@ class BucketFillTool(EditorTool):
 
     def on_mouse_pressed(self, event):
         if event.buttons.left:
-            self.fill_image(event.pos, (*self.color, 255))
+            self.fill_image(event.pos, 1)
         elif event.buttons.right:
-            self.fill_image(event.pos, (0, 0, 0, 0))
+            self.fill_image(event.pos, 0)
 
     def on_tablet_pressed(self, event):
         if event.buttons.left:
-            self.fill_image(event.pos, (*self.color, 255))
+            self.fill_image(event.pos, 1)
         elif event.buttons.left and event.buttons.right:
-            self.fill_image(event.pos, (0, 0, 0, 0))
+            self.fill_image(event.pos, 0)
 
     def fill_image(self, pos, color):
         if not self.is_mask:
@@ -25,6 +25,6 @@ class BucketFillTool(EditorTool):
             return
 
         snapshot = self.canvas.copy()
-        util.draw.flood_fill(self.canvas, pos, color)
+        rect = util.draw.flood_fill(self.canvas, pos, color)
         self.push_undo_snapshot(snapshot, self.canvas, undo_text="Bucket Fill")
-        self.notify_dirty()
+        self.notify_dirty(rect)
@@ -6,10 +6,54 @@ from ... import util
 
 class ContourTool(EditorTool):
 
+    # The contour overlay is cached and only recomputed for tiles of this size
+    # that differ from the canvas the overlay was computed from
+    tile_size = 256
+
+    def on_create(self):
+        self._source = None
+        self._version = None
+        self._reference = None
+        self._output = None
+
     def on_paint(self):
         if not self.is_mask:
             return self.canvas
 
-        output = np.zeros(self.canvas.shape, dtype=np.uint8)
-        util.draw.contours(output, self.canvas, (*self.color, 255))
-        return output
+        if self._source is self.canvas and self._version == self.canvas_version:
+            return self._output
+
+        self._update_contours()
+        self._source = self.canvas
+        self._version = self.canvas_version
+        return self._output
+
+    def _update_contours(self):
+        if self._reference is None or self._reference.shape != self.canvas.shape:
+            self._output = np.zeros(self.canvas.shape, dtype=np.uint8)
+            util.draw.contours(self._output, self.canvas, 1)
+            self._reference = self.canvas.copy()
+            return
+
+        changed = self.canvas != self._reference
+        if not changed.any():
+            return
+
+        # A contour pixel only depends on its immediate neighbors, hence a tile
+        # padded by two pixels yields the same contours as the whole canvas. For
+        # the same reason changes next to a tile also affect its contours.
+        output = self._output.copy()
+        h, w = self.canvas.shape[:2]
+        for y in range(0, h, self.tile_size):
+            for x in range(0, w, self.tile_size):
+                y2, x2 = min(y + self.tile_size, h), min(x + self.tile_size, w)
+                if not changed[max(y - 1, 0):y2 + 1, max(x - 1, 0):x2 + 1].any():
+                    continue
+                py, px = max(y - 2, 0), max(x - 2, 0)
+                padded = self.canvas[py:min(y2 + 2, h), px:min(x2 + 2, w)]
+                tile = np.zeros(padded.shape, dtype=np.uint8)
+                util.draw.contours(tile, padded, 1)
+                output[y:y2, x:x2] = tile[y - py:y2 - py, x - px:x2 - px]
+
+        self._output = output
+        self._reference = self.canvas.copy()
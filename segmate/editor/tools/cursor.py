@@ -3,5 +3,7 @@ from ..editortool import EditorTool
 
 class CursorTool(EditorTool):
 
+    supports_tiles = True
+
     def on_show(self):
         self.enable_selection(True)
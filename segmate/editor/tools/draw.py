@@ -8,6 +8,8 @@ from PySide2.QtGui import *
 
 class DrawTool(EditorTool):
 
+    supports_tiles = True
+
     def on_create(self):
         self._brush_size = 2
         self._eraser_size = 4
@@ -55,7 +57,8 @@ class DrawTool(EditorTool):
             self.send_status_message("The image layer is not editable...")
             return
         if not self._have_undo_copy:
-            self._undo_copy = self.canvas.copy()
+            # Tiled layers are not copied, tiles are saved once they are modified
+            self._undo_copy = {} if self.is_tiled else self.canvas.copy()
             self._have_undo_copy = True
         self._last_point = pos
         self._draw_line(pos, erase)
@@ -67,7 +70,10 @@ class DrawTool(EditorTool):
         self._draw_line(pos, erase)
         self._draw = False
         if self._have_undo_copy:
-            self.push_undo_snapshot(self._undo_copy, self.canvas, undo_text="Draw")
+            if self.is_tiled:
+                self.push_tile_undo_snapshot(self._undo_copy, undo_text="Draw")
+            else:
+                self.push_undo_snapshot(self._undo_copy, self.canvas, undo_text="Draw")
             self._have_undo_copy = False
 
     def _moved(self, pos, erase):
@@ -76,11 +82,35 @@ class DrawTool(EditorTool):
         self._draw_line(pos, erase)
 
     def _draw_line(self, end_point, erase):
-        color = (*self.color, 255) if not erase else (0, 0, 0, 0)
+        color = 1 if not erase else 0
         width = self._brush_size if not erase else self._eraser_size
-        util.draw.line(self.canvas, self._last_point, end_point, color, width=width)
+        if self.is_tiled:
+            rect = self._draw_tiled_line(self._last_point, end_point, color, width)
+        else:
+            rect = util.draw.line(self.canvas, self._last_point, end_point, color, width=width)
         self._last_point = end_point
-        self.notify_dirty()
+        self.notify_dirty(rect)
+
+    def _draw_tiled_line(self, start_point, end_point, color, width):
+        # Draw into a copy of the region covered by the line and the brush, then
+        # write back only the modified part, which touches just the tiles below it
+        pad = width // 2 + 2
+        y1 = max(int(min(start_point[0], end_point[0])) - pad, 0)
+        x1 = max(int(min(start_point[1], end_point[1])) - pad, 0)
+        y2 = int(max(start_point[0], end_point[0])) + pad + 1
+        x2 = int(max(start_point[1], end_point[1])) + pad + 1
+        region = self.canvas.read([(y1, x1), (y2, x2)])
+        if region.size == 0:
+            return None
+        (ry1, rx1), (ry2, rx2) = util.draw.line(region,
+            (start_point[0] - y1, start_point[1] - x1),
+            (end_point[0] - y1, end_point[1] - x1), color, width=width)
+        rect = [(y1 + ry1, x1 + rx1), (y1 + ry2, x1 + rx2)]
+        for key in self.canvas.tiles_in(rect):
+            if key not in self._undo_copy:
+                self._undo_copy[key] = self.canvas.tile(*key).copy()
+        self.canvas.write(rect[0], region[ry1:ry2, rx1:rx2])
+        return rect
 
 
 class DrawToolInspector(EditorToolWidget):
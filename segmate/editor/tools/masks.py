@@ -22,7 +22,7 @@ class MasksTool(EditorTool):
             mask[util.mask.selection(mask, self.selection_rect)] = 0
         else:
             mask = np.zeros(mask.shape, dtype=np.uint8)
-        image = util.mask.color(mask, self.color)
+        image = util.mask.compact(mask)
 
         self.push_undo_snapshot(self.canvas, image, undo_text="Clear Mask")
         self.canvas = image
@@ -40,7 +40,7 @@ class MasksTool(EditorTool):
                 output[(mask == 1) & (selection == 1)] = 1
             else:
                 output[mask == 1] = 1
-        output = util.mask.color(output, self.color)
+        output = util.mask.compact(output)
 
         self.push_undo_snapshot(self.canvas, output, undo_text="Merge Mask")
         self.canvas = output
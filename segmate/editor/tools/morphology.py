@@ -1,11 +1,14 @@
 import numpy as np
-from scipy import ndimage as ndi
-from skimage.filters import rank
-import skimage.morphology as morph
 
 from ..editortool import EditorTool
 from ..widgets import EditorToolWidget, Button
 from ... import util
+from ...lazy import lazy_import
+
+# Imported once the tool is used for the first time
+ndi = lazy_import("scipy.ndimage")
+rank = lazy_import("skimage.filters.rank")
+morph = lazy_import("skimage.morphology")
 
 
 class MorphologyTool(EditorTool):
@@ -31,68 +34,92 @@ class MorphologyTool(EditorTool):
             self._fill_holes()
 
     def _fill_holes(self):
-        if not self.is_mask:
-            return
-
-        mask = util.mask.binary(self.canvas)
-        filled = ndi.binary_fill_holes(mask)
-
-        if self.selection_rect:
-            selection = util.mask.selection(mask, self.selection_rect)
-            filled[~selection] = mask[~selection]
-
-        output = util.mask.color(filled, self.color)
-        self.push_undo_snapshot(self.canvas, output, undo_text="Fill Holes")
-        self.canvas = output
-        self.notify_dirty()
+        self._apply(ndi.binary_fill_holes, "Fill Holes", self._hole_region)
 
     def _dilate(self):
-        if not self.is_mask:
-            return
-
-        mask = util.mask.binary(self.canvas)
-        dilated = morph.binary_dilation(mask)
-
-        if self.selection_rect:
-            selection = util.mask.selection(mask, self.selection_rect)
-            dilated[~selection] = mask[~selection]
-
-        output = util.mask.color(dilated, self.color)
-        self.push_undo_snapshot(self.canvas, output, undo_text="Dilate")
-        self.canvas = output
-        self.notify_dirty()
+        self._apply(morph.binary_dilation, "Dilate", self._halo_region)
 
     def _erode(self):
-        if not self.is_mask:
-            return
-
-        mask = util.mask.binary(self.canvas)
-        eroded = morph.binary_erosion(mask)
-
-        if self.selection_rect:
-            selection = util.mask.selection(mask, self.selection_rect)
-            eroded[~selection] = mask[~selection]
-
-        output = util.mask.color(eroded, self.color)
-        self.push_undo_snapshot(self.canvas, output, undo_text="Erode")
-        self.canvas = output
-        self.notify_dirty()
+        self._apply(morph.binary_erosion, "Erode", self._halo_region)
 
     def _skeletonize(self):
+        self._apply(morph.skeletonize, "Skeletonize", self._component_region)
+
+    def _apply(self, operation, undo_text, region):
+        # Only the region the result within the selection depends on is processed,
+        # and only the selection is written back
         if not self.is_mask:
             return
 
-        mask = util.mask.binary(self.canvas)
-        skeletonized = morph.skeletonize(mask)
-
-        if self.selection_rect:
-            selection = util.mask.selection(mask, self.selection_rect)
-            skeletonized[~selection] = mask[~selection]
-
-        output = util.mask.color(skeletonized, self.color)
-        self.push_undo_snapshot(self.canvas, output, undo_text="Skeletonize")
-        self.canvas = output
-        self.notify_dirty()
+        (y1, x1), (y2, x2) = self._selection_bounds()
+        if y2 <= y1 or x2 <= x1:
+            return
+        (hy1, hx1), (hy2, hx2) = region([(y1, x1), (y2, x2)])
+
+        mask = util.mask.binary(self.canvas[hy1:hy2, hx1:hx2])
+        result = util.mask.compact(operation(mask))
+        result = result[y1 - hy1:y2 - hy1, x1 - hx1:x2 - hx1]
+
+        snapshot = self.canvas[y1:y2, x1:x2].copy()
+        self.canvas[y1:y2, x1:x2] = result
+        self.push_undo_snapshot(snapshot, result, undo_text=undo_text, origin=(y1, x1))
+        self.notify_dirty([(y1, x1), (y2, x2)])
+
+    def _halo_region(self, bounds):
+        # A halo of one pixel makes dilation and erosion at the border of the
+        # selection exact, both only depend on the 3x3 neighbourhood of a pixel
+        (y1, x1), (y2, x2) = bounds
+        h, w = self.canvas.shape[:2]
+        return [(max(y1 - 1, 0), max(x1 - 1, 0)), (min(y2 + 1, h), min(x2 + 1, w))]
+
+    def _hole_region(self, bounds):
+        # Whether background is a hole depends on the whole background component,
+        # which may be enclosed by foreground far outside of the selection
+        return self._connected_region(bounds, ndi.generate_binary_structure(2, 1),
+            background=True)
+
+    def _component_region(self, bounds):
+        # The skeleton of a component depends on the whole component
+        return self._connected_region(bounds, np.ones((3, 3)))
+
+    def _connected_region(self, bounds, structure, *, background=False):
+        # Starting at the selection, the region is grown until every component that
+        # intersects the selection lies inside of it, so the cost depends on these
+        # components and not on the size of the mask. A background component that
+        # reaches the border of the mask is never a hole, it needs not be complete.
+        (sy1, sx1), (sy2, sx2) = bounds
+        (y1, x1), (y2, x2) = self._halo_region(bounds)
+        h, w = self.canvas.shape[:2]
+        while True:
+            mask = util.mask.binary(self.canvas[y1:y2, x1:x2])
+            labels, _ = ndi.label(~mask if background else mask, structure=structure)
+            touched = np.unique(labels[sy1 - y1:sy2 - y1, sx1 - x1:sx2 - x1])
+            edges = [labels[0], labels[:, 0], labels[-1], labels[:, -1]]
+            at_border = [y1 == 0, x1 == 0, y2 == h, x2 == w]
+            if background:
+                for edge in (e for e, border in zip(edges, at_border) if border):
+                    touched = np.setdiff1d(touched, edge)
+            touched = touched[touched != 0]
+            grow = [not border and np.isin(edge, touched).any()
+                for edge, border in zip(edges, at_border)]
+            if not any(grow):
+                return [(y1, x1), (y2, x2)]
+            # Doubling the region in every direction a component leaves it keeps
+            # the number of iterations logarithmic
+            dy, dx = y2 - y1, x2 - x1
+            y1 = max(y1 - dy, 0) if grow[0] else y1
+            x1 = max(x1 - dx, 0) if grow[1] else x1
+            y2 = min(y2 + dy, h) if grow[2] else y2
+            x2 = min(x2 + dx, w) if grow[3] else x2
+
+    def _selection_bounds(self):
+        h, w = self.canvas.shape[:2]
+        if not self.selection_rect:
+            return [(0, 0), (h, w)]
+        (y1, x1), (y2, x2) = self.selection_rect
+        y1, y2 = np.clip([int(y1), int(y2)], 0, h)
+        x1, x2 = np.clip([int(x1), int(x2)], 0, w)
+        return [(y1, x1), (y2, x2)]
 
     def _watershed(self):
         if not self.is_mask:
@@ -113,7 +140,7 @@ class MorphologyTool(EditorTool):
             selection = util.mask.selection(markers, self.selection_rect)
             result_mask[~selection] = util.mask.binary(self.canvas)[~selection]
 
-        output = util.mask.color(result_mask, self.color)
+        output = util.mask.compact(result_mask)
         self.push_undo_snapshot(self.canvas, output, undo_text="Watershed")
         self.canvas = output
         self.notify_dirty()
@@ -1,26 +1,33 @@
+import functools
 import warnings
 
 from PySide2.QtCore import *
 from PySide2.QtGui import *
 from PySide2.QtWidgets import *
 
-import matplotlib as mpl
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_qt5agg import (
-    NavigationToolbar2QT as NavBar,
-    FigureCanvas,
-)
+from ...lazy import lazy_import
 
+# Matplotlib and its Qt backend are imported when the first plot is created
+mpl = lazy_import("matplotlib")
+mpl_figure = lazy_import("matplotlib.figure")
+mpl_backend = lazy_import("matplotlib.backends.backend_qt5agg")
 
-class WrappedCanvas(FigureCanvas):
 
-    def draw(self):
-        try:
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                super().draw()
-        except:
-            pass
+@functools.lru_cache(maxsize=None)
+def _wrapped_canvas():
+    # The canvas class derives from the backend, hence it is created on demand
+
+    class WrappedCanvas(mpl_backend.FigureCanvas):
+
+        def draw(self):
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    super().draw()
+            except:
+                pass
+
+    return WrappedCanvas
 
 
 class MatplotWidget(QWidget):
@@ -39,15 +46,15 @@ class MatplotWidget(QWidget):
         layout = QVBoxLayout(self)
         layout.setContentsMargins(0, 0, 0, 0)
 
-        self.figure = Figure(facecolor="none")
-        self.canvas = WrappedCanvas(self.figure)
+        self.figure = mpl_figure.Figure(facecolor="none")
+        self.canvas = _wrapped_canvas()(self.figure)
         self.setStyleSheet("background-color:palette(alternate-base);")
 
         layout.addWidget(self.canvas)
         if not show_navbar:
             return
 
-        navbar = NavBar(self.canvas, self, coordinates=False)
+        navbar = mpl_backend.NavigationToolbar2QT(self.canvas, self, coordinates=False)
         navbar_container = QWidget()
         navbar_container.setContentsMargins(0, 0, 0, 0)
         navbar_container.setFixedHeight(50)
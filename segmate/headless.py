@@ -0,0 +1,339 @@
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import json
+import multiprocessing
+import os
+from os import cpu_count
+from pathlib import Path
+import shutil
+import sys
+import types
+
+from PySide2.QtCore import QObject, Signal
+from PySide2.QtWidgets import QApplication
+
+from . import plugins, project, util
+from .archive import ProjectArchive
+from .editor.editortool import EditorTool
+from .store import DataStore
+
+
+# Images are handed to the workers in chunks of this size. Results of a chunk are
+# staged until the whole chunk is done, then they are written to the archive
+CHUNK_SIZE = 64
+
+_runner = None
+
+
+class _BatchItem(QObject):
+    """
+    Stands in for the layers item of the editor, so that tools can run without a
+    scene. Only the state tools access is provided, repaints are ignored.
+    """
+
+    image_modified = Signal()
+
+    def __init__(self, store, layer_idx):
+        super().__init__()
+        self.scene = types.SimpleNamespace(data_store=store)
+        self.active = layer_idx
+        self.image_index = None
+        self.layer_names = store.folders
+        self.show_selection = False
+        self.selection_rect = None
+        self.panes = None
+        self._layer_data = None
+        self._colors = store.colors
+        self._masks = store.masks
+        self._versions = [0] * len(store.folders)
+
+    def load(self, image_idx, layers):
+        self._layer_data = [layer.copy() for layer in layers]
+        self.image_index = image_idx
+
+    def invalidate(self, layer_idx=None, rect=None):
+        for i in range(len(self._versions)) if layer_idx is None else [layer_idx]:
+            self._versions[i] += 1
+
+    def update(self):
+        pass
+
+    def setCursor(self, cursor):
+        pass
+
+    def _compact(self, layer_idx, image):
+        if self._masks[layer_idx] and len(image.shape) == 3:
+            return util.mask.compact(image)
+        return image
+
+
+class _BatchRunner:
+
+    def __init__(self, archive_path, folders, masks, colors, plugin_name, layer_idx, staging):
+        self.app = _application()
+        self.archive = ProjectArchive(archive_path, staging)
+        self.archive.open()
+        # Only a few images are held at a time, results are pinned until saved
+        self.store = DataStore(data_root=staging, folders=folders, masks=masks,
+            colors=colors, archive=self.archive, prefetch_count=0,
+            cache_size=256 * 1024**2)
+        self.item = _BatchItem(self.store, layer_idx)
+        self.tool = _plugin_class(plugin_name)()
+        self.tool._item = self.item
+        self.tool.on_create()
+
+    def process(self, indices, staging):
+        # Modified masks of the chunk are written below its own staging folder
+        self.archive.overlay_root = Path(staging)
+        active = self.item.active
+        changed = []
+        for idx in indices:
+            self.item.load(idx, self.store[idx])
+            self.tool.canvas = self.item._layer_data[active]
+            self.tool.color = self.item._colors[active]
+            self.tool.is_mask = self.item._masks[active]
+
+            versions = list(self.item._versions)
+            result = self.tool.on_batch()
+            if result is not None:
+                self.item._layer_data[active] = self.item._compact(active, result)
+            if result is not None or self.item._versions != versions:
+                self.store[idx] = self.item._layer_data
+                changed.append(idx)
+            else:
+                self.store.discard(idx)
+
+        self.store.save_to_disk()
+        for idx in changed:
+            self.store.discard(idx)
+        return changed
+
+
+def run(project_path, plugin_name, *, layer=None, first=None, last=None, workers=None,
+        chunk_size=CHUNK_SIZE, restart=False):
+    """Run the batch logic of a plugin tool over the images of a project.
+
+    Chunks of images are processed by worker processes in parallel. Every chunk
+    is written to the archive as soon as it is done and recorded in a checkpoint
+    next to the archive, an interrupted run resumes after the last written chunk.
+
+    Args:
+        project_path: Path of the project archive
+        plugin_name: Name of the plugin, as registered by initialize_plugins
+        layer: Name of the layer the tool works on, defaults to the first mask
+        first: Index of the first image to process, defaults to the first image
+        last: Index of the last image to process, defaults to the last image
+        workers: Number of worker processes, defaults to the number of cores
+        chunk_size: Number of images per chunk
+        restart: Ignore the checkpoint of a previous run
+
+    Returns:
+        Number of images the tool modified
+    """
+    _application()
+    _plugin_class(plugin_name)
+
+    # Writing the project clears its edit journal, so unsaved edits of segmate must
+    # be detected before anything is written, see _write_project
+    current = project.open_project(project_path)
+    if current.recovered:
+        current.close()
+        raise ValueError("'{0}' has unsaved edits, open and save it in segmate first.".format(
+            project_path))
+    store = DataStore.from_project(current, prefetch_count=0)
+
+    try:
+        layer_idx = _layer_index(store, layer)
+        first = 0 if first is None else first
+        last = len(store) - 1 if last is None else last
+        if not 0 <= first <= last < len(store):
+            raise ValueError("Invalid image range {0}-{1}.".format(first, last))
+
+        checkpoint_path = Path(str(current.archive_path) + ".checkpoint")
+        params = {"plugin": plugin_name, "layer": store.folders[layer_idx],
+            "first": first, "last": last, "chunk_size": chunk_size}
+        done = set() if restart else _read_checkpoint(checkpoint_path, params)
+        chunks = [(i, range(start, min(start + chunk_size, last + 1)))
+            for i, start in enumerate(range(first, last + 1, chunk_size)) if i not in done]
+        if done:
+            print("Resuming, {0} of {1} chunks are already done.".format(
+                len(done), len(done) + len(chunks)))
+
+        staging = Path(current.temp_dir.name) / "staging"
+        modified = _run_chunks(current, store, chunks, staging, workers, params,
+            checkpoint_path, done, plugin_name, layer_idx)
+        # The workers are gone, only now the archive may be rewritten as a whole
+        _write_project(current)
+    finally:
+        store.close()
+        current.close()
+
+    # Every chunk is part of the archive, the checkpoint is not needed anymore
+    if checkpoint_path.exists():
+        checkpoint_path.unlink()
+    return modified
+
+
+def _run_chunks(current, store, chunks, staging, workers, params, checkpoint_path, done,
+        plugin_name, layer_idx):
+    workers = workers or cpu_count() or 1
+    total = len(done) + len(chunks)
+    modified = 0
+
+    # Spawned workers do not inherit the threads and Qt state of this process
+    context = multiprocessing.get_context("spawn")
+    initargs = (str(current.archive_path), store.folders, store.masks, store.colors,
+        plugin_name, layer_idx, str(staging / "initial"))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+            initializer=_init_worker, initargs=initargs) as pool:
+        jobs = iter(chunks)
+        pending = {}
+        try:
+            while True:
+                while len(pending) < 2 * workers:
+                    chunk = next(jobs, None)
+                    if chunk is None:
+                        break
+                    chunk_staging = staging / "chunk-{0}".format(chunk[0])
+                    future = pool.submit(_process_chunk, list(chunk[1]), str(chunk_staging))
+                    pending[future] = (chunk[0], chunk_staging)
+                if not pending:
+                    break
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    chunk, chunk_staging = pending.pop(future)
+                    changed = future.result()
+                    _commit_chunk(current, store, changed, chunk_staging)
+                    done.add(chunk)
+                    _write_checkpoint(checkpoint_path, params, done)
+                    modified += len(changed)
+                    print("Chunk {0}/{1} done, {2} images modified.".format(
+                        len(done), total, modified))
+        except BaseException:
+            # The checkpoint only holds chunks that were written, the rest is redone
+            for future in pending:
+                future.cancel()
+            raise
+    return modified
+
+
+def _commit_chunk(current, store, changed, staging):
+    for idx in changed:
+        for i, folder in enumerate(store.folders):
+            staged = staging / folder / store.files[idx]
+            if store.masks[i] and staged.is_file():
+                os.replace(str(staged), str(store.mask_target(idx, i)))
+        store.discard(idx)
+    shutil.rmtree(str(staging), ignore_errors=True)
+    # The workers have mapped the archive, compacting it now would replace the
+    # data below them, hence it is only compacted once all chunks are done
+    _write_project(current, allow_compact=False)
+
+
+def _write_project(current, **kwargs):
+    # The project may have been edited in segmate while the run was going on. The
+    # journal holds these edits and is cleared by writing, so the run stops instead.
+    if current.journal.replay():
+        raise ValueError("'{0}' was edited in segmate during the run, save it there and "
+            "run again to resume.".format(current.archive_path))
+    project.write_project(current, **kwargs)
+
+
+def _read_checkpoint(path, params):
+    if not path.is_file():
+        return set()
+    try:
+        with open(path, "r") as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        print("The checkpoint '{0}' is damaged, starting over.".format(path))
+        return set()
+    if checkpoint.get("params") != params:
+        print("The checkpoint '{0}' is from a different run, starting over.".format(path))
+        return set()
+    return set(checkpoint.get("done", []))
+
+
+def _write_checkpoint(path, params, done):
+    # Replace the checkpoint atomically, an interrupted write keeps the previous one
+    temp_path = path.with_name(path.name + ".tmp")
+    with open(temp_path, "w") as f:
+        json.dump({"params": params, "done": sorted(done)}, f)
+    os.replace(str(temp_path), str(path))
+
+
+def _layer_index(store, layer):
+    if layer is None:
+        if not any(store.masks):
+            raise ValueError("The project has no mask layer.")
+        return store.masks.index(True)
+    if layer not in store.folders:
+        raise ValueError("The project has no layer '{0}'.".format(layer))
+    return store.folders.index(layer)
+
+
+def _application():
+    # Plugins may still rely on Qt, hence there is an application without a display
+    app = QApplication.instance()
+    if app is None:
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        plugins.preload_modules()
+        app = QApplication([sys.argv[0]])
+        plugins.initialize_plugins()
+    return app
+
+
+def _plugin_class(plugin_name):
+    plugin = plugins.get_plugins().get(plugin_name)
+    if plugin is None:
+        raise ValueError("There is no plugin '{0}'.".format(plugin_name))
+    class_ = plugin.load()
+    if class_ is None:
+        raise ValueError(plugin.error)
+    if class_.on_batch is EditorTool.on_batch:
+        raise ValueError("The plugin '{0}' does not support batch processing.".format(
+            plugin_name))
+    return class_
+
+
+def _init_worker(*args):
+    global _runner
+    _runner = _BatchRunner(*args)
+
+
+def _process_chunk(indices, staging):
+    return _runner.process(indices, staging)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="segmate-headless",
+        description="Run a segmate plugin over the images of a project without a display.")
+    parser.add_argument("project", help="path of the project archive")
+    parser.add_argument("plugin", help="name of the plugin")
+    parser.add_argument("--layer", help="layer the tool works on, defaults to the first mask")
+    parser.add_argument("--first", type=int, help="first image to process, starting at 1")
+    parser.add_argument("--last", type=int, help="last image to process")
+    parser.add_argument("--workers", type=int, help="number of worker processes")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+        help="number of images per chunk (default: {0})".format(CHUNK_SIZE))
+    parser.add_argument("--restart", action="store_true",
+        help="ignore the checkpoint of an interrupted run")
+    args = parser.parse_args()
+
+    try:
+        modified = run(args.project, args.plugin, layer=args.layer,
+            first=None if args.first is None else args.first - 1,
+            last=None if args.last is None else args.last - 1,
+            workers=args.workers, chunk_size=max(args.chunk_size, 1), restart=args.restart)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        print("Interrupted, finished chunks are kept, run again to resume.")
+        sys.exit(130)
+    print("Done, {0} images modified.".format(modified))
+
+
+if __name__ == "__main__":
+    main()
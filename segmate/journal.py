@@ -0,0 +1,140 @@
+import os
+from pathlib import Path
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+
+class EditJournal:
+    """
+    Append-only log of edited masks, which is written continuously by a background
+    thread, so that unsaved work survives a crash. Each record holds the complete
+    label map of one mask, the most recent record of a mask wins on replay. The
+    journal is cleared once the edits are part of the project archive. Outdated
+    records are dropped by rewriting the journal once they dominate its size.
+    """
+
+    MAGIC = b"SGMJ"
+    HEADER = struct.Struct("<4sIIIII")
+
+    # The journal is compacted once it is this many times larger than the most
+    # recent records of all masks, but not before it reaches the minimum size
+    COMPACTION_FACTOR = 4
+    COMPACTION_MIN_SIZE = 1024**2
+
+    def __init__(self, path, *, interval=2.0):
+        self.path = Path(path)
+        self.interval = interval
+        self._pending = {}
+        # The lock only guards the pending masks, so recording never waits for the
+        # disk; the file lock serializes writing, compacting and clearing the file.
+        # Where both are needed, the file lock is always taken first.
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._latest = {}
+        self._size = 0
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._closed = False
+
+    def record(self, folder, name, mask):
+        # Only a reference is kept, the mask is copied when the journal is written.
+        # A mask that is still being edited at that point is written again later.
+        with self._lock:
+            self._pending[(folder, name)] = mask
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def flush(self):
+        with self._file_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+
+            records = {key: self._encode(key[0], key[1], np.array(mask, dtype=np.uint8))
+                for key, mask in pending.items()}
+            with open(self.path, "ab") as f:
+                for record in records.values():
+                    f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+            self._latest.update(records)
+            self._size += sum(len(record) for record in records.values())
+            live = sum(len(record) for record in self._latest.values())
+            if self._size > max(self.COMPACTION_FACTOR * live, self.COMPACTION_MIN_SIZE):
+                self._compact()
+
+    def replay(self):
+        masks = {}
+        if not self.path.is_file():
+            return masks
+        data = self.path.read_bytes()
+        offset = 0
+        latest = {}
+        while offset + self.HEADER.size <= len(data):
+            magic, key_size, height, width, size, crc = \
+                self.HEADER.unpack_from(data, offset)
+            start = offset + self.HEADER.size
+            end = start + key_size + size
+            # A record torn by a crash ends the journal
+            if magic != self.MAGIC or end > len(data):
+                break
+            payload = data[start + key_size:end]
+            if zlib.crc32(payload) != crc:
+                break
+            folder, name = data[start:start + key_size].decode("utf-8").split("/", 1)
+            mask = np.frombuffer(zlib.decompress(payload), dtype=np.uint8)
+            masks[(folder, name)] = mask.reshape(height, width).copy()
+            latest[(folder, name)] = data[offset:end]
+            offset = end
+
+        with self._file_lock:
+            self._latest, self._size = latest, offset
+            if offset < len(data):
+                # Records appended after a torn one would never be replayed
+                with open(self.path, "r+b") as f:
+                    f.truncate(offset)
+        return masks
+
+    def clear(self):
+        with self._file_lock, self._lock:
+            self._pending.clear()
+            self._latest, self._size = {}, 0
+            if self.path.is_file():
+                self.path.unlink()
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.interval)
+            self.flush()
+
+    def _compact(self):
+        # Must be called while holding the file lock. The rewritten journal only
+        # holds the most recent record of every mask and replaces the old one at once.
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(temp_path, "wb") as f:
+            for record in self._latest.values():
+                f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(str(temp_path), str(self.path))
+        self._size = sum(len(record) for record in self._latest.values())
+
+    def _encode(self, folder, name, mask):
+        key = "{0}/{1}".format(folder, name).encode("utf-8")
+        payload = zlib.compress(mask.tobytes(), 1)
+        header = self.HEADER.pack(self.MAGIC, len(key), mask.shape[0], mask.shape[1],
+            len(payload), zlib.crc32(payload))
+        return header + key + payload
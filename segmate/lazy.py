@@ -0,0 +1,64 @@
+import importlib
+import os
+import sys
+import time
+import types
+
+
+# Set this environment variable to import all lazily imported modules right away,
+# e.g. to rule out deferred imports when debugging
+EAGER_IMPORTS = "SEGMATE_EAGER_IMPORTS"
+
+_import_times = {}
+
+
+class _LazyModule(types.ModuleType):
+    """
+    Placeholder for a module, which is imported on first attribute access. The
+    placeholder then forwards all attribute lookups to the imported module.
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__["_lazy_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_lazy_module"]
+        if module is None:
+            start = time.perf_counter()
+            module = importlib.import_module(self.__name__)
+            _import_times[self.__name__] = time.perf_counter() - start
+            self.__dict__["_lazy_module"] = module
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_lazy_module"] is not None else "not loaded"
+        return "<lazy module '{0}' ({1})>".format(self.__name__, state)
+
+
+def lazy_import(name):
+    """Import a module on first use.
+
+    Args:
+        name: Absolute name of the module, e.g. 'scipy.ndimage'
+
+    Returns:
+        The module, if it was already imported, otherwise a placeholder that
+        imports the module as soon as one of its attributes is accessed
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    if os.environ.get(EAGER_IMPORTS):
+        return importlib.import_module(name)
+    return _LazyModule(name)
+
+
+def import_times():
+    """Returns the time in seconds it took to import each deferred module."""
+    return dict(_import_times)
@@ -14,6 +14,7 @@ def main():
     real_path = os.path.dirname(os.path.realpath(__file__))
     os.chdir(real_path)
 
+    plugins.preload_modules()
     QApplication.setAttribute(Qt.AA_EnableHighDpiScaling)
     app = Application(sys.argv)
     darktheme.apply(app)
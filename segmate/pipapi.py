@@ -1,7 +1,13 @@
 import pathlib
+import re
 import subprocess
 import sys
 
+try:
+    from importlib import metadata
+except ImportError:
+    metadata = None
+
 
 def is_venv():
     if hasattr(sys, "real_prefix"):
@@ -38,3 +44,17 @@ def installed(*, user=False):
     output = output.decode("utf-8").rstrip()
     lines = output.split("\n")[2:]
     return [l.split(" ")[0].strip().lower() for l in lines]
+
+
+def canonical_name(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def installed_distributions():
+    """Names of all installed distributions, read in process from their metadata."""
+    if metadata is not None:
+        names = (dist.metadata["Name"] for dist in metadata.distributions())
+    else:
+        import pkg_resources
+        names = (dist.project_name for dist in pkg_resources.working_set)
+    return {canonical_name(name) for name in names if name}
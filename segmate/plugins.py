@@ -1,36 +1,126 @@
+import hashlib
 import importlib
+import importlib.util
 import inspect
 import json
 import pathlib
+import re
 import sys
+import time
 
-from pkg_resources import Requirement
 from PySide2.QtCore import *
 from PySide2.QtWidgets import *
 from PySide2.QtGui import *
 
-from . import pipapi
+from . import pipapi, settings
 from .editor.editortool import EditorTool
 
 
 # When a dynamically imported plugin itself tries to import torch (> 1.0.1) it crashes
-# when it is initialized after QApplication. Therefore try to import it here and swallow
-# an import error for systems were torch is not installed. This is obviously a band-aid,
-# and to be removed as as soon as possible.
+# when it is initialized after QApplication. Therefore modules listed here are imported
+# by preload_modules before the application is created, if they are installed at all.
+# Plugins do not always declare them, so this does not depend on the registered plugins.
+# This is obviously a band-aid, and to be removed as soon as possible.
 # Also see: https://github.com/pytorch/pytorch/issues/11326
-try:
-    import torch
-except ImportError:
-    pass
+PRELOAD_MODULES = ("torch",)
 
 
+# Imports taking longer than this are reported on the console
+SLOW_IMPORT_SECONDS = 1.0
+
 _plugins = {}
 
 
+class Plugin:
+    """
+    A plugin registered from its 'plugin.json'. The module of the plugin is only
+    imported once the tool is requested for the first time, which keeps heavy
+    dependencies of unused plugins out of the application startup.
+    """
+
+    def __init__(self, directory, name, module, class_name, preload=()):
+        self.directory = directory
+        self.name = name
+        self.module = module
+        self.class_name = class_name
+        # Dependencies of the plugin, which must be imported before QApplication
+        self.preload = list(preload)
+        self.import_time = None
+        self.error = None
+        self._class = None
+
+    @property
+    def loaded(self):
+        return self._class is not None
+
+    def load(self):
+        if self._class is not None or self.error is not None:
+            return self._class
+
+        # Importing these after the application was created crashes, a module that
+        # was installed after the start is only preloaded by a restart
+        missing = [name for name in self.preload if name not in sys.modules]
+        if missing:
+            self.error = "Please restart segmate to enable the plugin '{0}', " \
+                "it depends on {1}.".format(self.name, ", ".join(missing))
+            print(self.error)
+            return None
+
+        # If there is any error we do not want the application to crash, therefore
+        # catch all errors unconditionally, report an error and continue
+        start = time.perf_counter()
+        try:
+            module = importlib.import_module("{0}.{1}".format(self.directory, self.module))
+            class_ = getattr(module, self.class_name)
+        except:
+            self.error = "There was an error loading the plugin '{0}'.".format(self.directory)
+            print(self.error)
+            return None
+        finally:
+            self.import_time = time.perf_counter() - start
+
+        if not (inspect.isclass(class_) and issubclass(class_, EditorTool)):
+            self.error = "'{0}' is not a subclass of 'EditorTool'.".format(class_)
+            print(self.error)
+            return None
+        if self.import_time > SLOW_IMPORT_SECONDS:
+            print("Importing the plugin '{0}' took {1:.2f}s.".format(
+                self.directory, self.import_time))
+        self._class = class_
+        return class_
+
+
 def get_plugins():
     return _plugins
 
 
+def preload_modules():
+    # Must be called before the application is created. Probing with find_spec is
+    # cheap, only modules that are actually installed are imported.
+    for name in PRELOAD_MODULES:
+        if importlib.util.find_spec(name) is None:
+            continue
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+
+def import_report():
+    """Returns one line per plugin with its import time, the slowest first."""
+    lines = []
+    ordered = sorted(_plugins.values(), key=lambda p: -(p.import_time or 0.0))
+    for plugin in ordered:
+        if plugin.import_time is None:
+            status = "not loaded yet"
+        else:
+            status = "{0:.3f}s".format(plugin.import_time)
+            if plugin.error is not None:
+                status += " (failed)"
+        lines.append("{0}: {1}".format(plugin.name, status))
+    return lines
+
+
 def _plugin_info(plugin_dir):
     if not plugin_dir.is_dir():
         return None
@@ -56,30 +146,26 @@ def initialize_plugins():
         return
     sys.path.insert(0, str(location))
 
+    # Only the metadata is read here, see Plugin.load
+    preload = set()
     for plugin_dir in location.iterdir():
         plugin_info = _plugin_info(plugin_dir)
         if plugin_info is None:
             continue
-
-        # If there is any error we do not want the application to crash, therefore
-        # catch all errors unconditionally, report an error and continue
+        plugin_preload = [name for name in
+            (_requirement_name(d) for d in plugin_info.get("dependencies", []))
+            if name in PRELOAD_MODULES]
+        preload.update(plugin_preload)
         try:
-            plugin_name = plugin_info["name"]
-            module_name = plugin_info["module"]
-            class_name = plugin_info["class"]
-
-            module = importlib.import_module("{0}.{1}".format(plugin_dir.name, module_name))
-            class_ = getattr(module, class_name)
-
-            if not (inspect.isclass(class_) and issubclass(class_, EditorTool)):
-                print("'{0}' is not a subclass of 'EditorTool', skipping...".format(class_))
-                continue
+            _plugins[plugin_dir.name] = Plugin(plugin_dir.name, plugin_info["name"],
+                plugin_info["module"], plugin_info["class"], plugin_preload)
+        except KeyError as e:
+            print("'{0}/plugin.json' is missing the key {1}, skipping...".format(
+                plugin_dir.name, e))
 
-            _plugins[plugin_dir.name] = [plugin_name, class_]
-        except:
-            print("There was an error loading the plugin '{0}', skipping..." \
-                .format(plugin_dir.name))
-            continue
+    if preload - set(sys.modules):
+        print("Plugins depend on {0}, please restart the application.".format(
+            ", ".join(sorted(preload - set(sys.modules)))))
 
 
 def missing_dependencies():
@@ -89,18 +175,50 @@ def missing_dependencies():
     if not location.exists():
         return
 
+    plugin_infos = [p / "plugin.json" for p in location.iterdir()
+        if (p / "plugin.json").is_file()]
+
+    # A warm start only compares the cache key, which changes whenever a plugin
+    # description is modified or packages are (un)installed
+    key = _dependency_cache_key(plugin_infos)
+    cached_key, cached_missing = settings.dependency_cache()
+    if cached_key == key:
+        return cached_missing
+
     collected_dependencies = []
-    for plugin_dir in location.iterdir():
-        plugin_info = _plugin_info(plugin_dir)
+    for plugin_info_path in plugin_infos:
+        plugin_info = _plugin_info(plugin_info_path.parent)
         if plugin_info is None:
             continue
 
         plugin_dependencies = plugin_info.get("dependencies", [])
         collected_dependencies.extend(
-            [Requirement.parse(p).name.lower() for p in plugin_dependencies])
+            [_requirement_name(p) for p in plugin_dependencies])
+
+    installed_dependencies = pipapi.installed_distributions()
+    missing = [d for d in collected_dependencies if d not in installed_dependencies]
+    settings.set_dependency_cache(key, missing)
+    return missing
+
 
-    installed_dependencies = pipapi.installed(user=False)
-    return [d for d in collected_dependencies if d not in installed_dependencies]
+def _requirement_name(requirement):
+    # The project name is everything before extras, version specifiers and markers
+    match = re.match(r"\s*([A-Za-z0-9][A-Za-z0-9._-]*)", requirement)
+    if match is None:
+        return requirement.strip().lower()
+    return pipapi.canonical_name(match.group(1))
+
+
+def _dependency_cache_key(plugin_infos):
+    # Installing or removing a distribution modifies the directory it lives in,
+    # hence the modification times of the search path cover the environment
+    stamps = [sys.executable, sys.version]
+    for path in sorted(plugin_infos) + [pathlib.Path(p) for p in sys.path if p]:
+        try:
+            stamps.append("{0}:{1}".format(path, path.stat().st_mtime_ns))
+        except OSError:
+            continue
+    return hashlib.sha1("\n".join(stamps).encode("utf-8")).hexdigest()
 
 
 class DependencyInstaller(QDialog):
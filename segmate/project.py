@@ -1,13 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import json
-from os import makedirs
+import os
+from os import cpu_count, makedirs
 from pathlib import Path
 import shutil
+import struct
 import tempfile
+import warnings
 import zipfile
+import zlib
 
 import imageio as io
 import numpy as np
+from PIL import Image
 from segmate import __version__
+from .archive import ProjectArchive
+from .journal import EditJournal
+
+
+# The archive is rewritten from scratch, once more than this fraction of it is
+# taken up by outdated versions of members that were saved incrementally
+COMPACTION_THRESHOLD = 0.25
+
+# Appending to the archive overwrites its central directory, which is kept in this
+# file next to the archive until the append is complete
+APPEND_BACKUP_SUFFIX = ".append-backup"
+
+# Records what was written by the last export, so that unchanged files are skipped
+EXPORT_MANIFEST = ".segmate-export.json"
 
 
 class Project:
@@ -20,77 +40,269 @@ class Project:
         self.layers = layers
         self.masks = masks
         self.colors = colors
+        # Data is read from the archive on demand, data_root only holds the files
+        # that were modified since the project was last written
+        self.archive = ProjectArchive(archive_path, data_root)
+        # Unsaved mask edits are journaled next to the archive, masks recovered
+        # from the journal of a crashed session are applied by the data store
+        self.journal = EditJournal(str(archive_path) + ".journal")
+        self.recovered = {}
+
+    def close(self):
+        self.journal.close()
+        self.archive.close()
+        self.temp_dir.cleanup()
+
+    @property
+    def meta(self):
+        return {"version": self.version, "layers": self.layers,
+            "masks": self.masks, "colors": self.colors}
 
 
-def new_project(archive_path, layers, masks, files, colors):
-    # Copy all files from data_root to a temp directory, patch up
-    # data_root and create the corresponding meta file - the callee is
-    # responsible for actually creating the archive via save_project
+def new_project(archive_path, layers, masks, files, colors, *, progress=None):
+    # Copy all files from data_root to a temp directory and patch up
+    # data_root - the callee is responsible for actually creating the
+    # archive via write_project, which also writes the meta file
     temp_dir = tempfile.TemporaryDirectory(prefix="segmate-")
     temp_path = Path(temp_dir.name)
+    try:
+        _import_files(temp_path / "data", layers, files, progress)
+    except Exception:
+        temp_dir.cleanup()
+        raise
+    return Project(temp_dir, Path(archive_path), temp_path / "data", __version__,
+        layers, masks, colors)
 
-    for folder, fpaths in zip(layers, files):
-        makedirs(temp_path / "data" / folder)
+
+def _import_files(data_root, layers, files, progress):
+    # Validate everything up front, copying and creating missing masks is then
+    # distributed over a pool of workers, since both are mostly waiting on disk
+    for fpaths in files:
         for path in fpaths:
-            path = Path(path)
-            if not path.is_file():
+            if not Path(path).is_file():
                 raise AttributeError("'{0}' is not a file!".format(path))
-            target = temp_path / "data" / folder / path.name
-            shutil.copy(path, target)
-
-    # Create missing masks
-    for image in files[0]:
-        for i, folder in enumerate(files[1:]):
-            folder = [Path(f).name for f in folder]
-            if Path(image).name in folder:
-                continue
-            data = io.imread(path, as_gray=True)
-            mask = np.zeros(data.shape, dtype=np.uint8)
-            target = temp_path / "data" / layers[i+1] / Path(image).name
-            io.imwrite(target, mask)
+    images = {Path(path).name: Path(path) for path in files[0]}
+    for folder in layers:
+        makedirs(data_root / folder)
 
-    with open(temp_path / "meta", "w+") as jf:
-        json_data = {"version": __version__, "layers": layers,
-                     "masks": masks, "colors": colors}
-        json.dump(json_data, jf)
+    with ThreadPoolExecutor(max_workers=(cpu_count() or 1) * 2) as pool:
+        sizes = dict(zip(images.keys(), pool.map(_image_size, images.values())))
+        tasks = [pool.submit(shutil.copy, path, data_root / layers[0] / name)
+            for name, path in images.items()]
+        for folder, fpaths in zip(layers[1:], files[1:]):
+            names = set()
+            for path in map(Path, fpaths):
+                if path.name not in images:
+                    raise AttributeError(
+                        "There is no corresponding image for '{0}'!".format(path))
+                names.add(path.name)
+                tasks.append(pool.submit(_copy_mask, path,
+                    data_root / folder / path.name, sizes[path.name]))
+            for name in images.keys() - names:
+                tasks.append(pool.submit(_blank_mask,
+                    data_root / folder / name, sizes[name]))
+
+        try:
+            for done, task in enumerate(as_completed(tasks), 1):
+                task.result()
+                if progress is not None:
+                    progress(done, len(tasks))
+        except Exception:
+            for task in tasks:
+                task.cancel()
+            raise
+
+
+def _image_size(path):
+    # Only the header is read, the pixel data is not decoded
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+    except OSError:
+        raise AttributeError("'{0}' is not a readable image!".format(path))
+    return height, width
 
-    return Project(temp_dir, Path(archive_path), temp_path / "data", __version__,
-        layers, masks, colors)
+
+def _copy_mask(path, target, size):
+    if _image_size(path) != size:
+        raise AttributeError("'{0}' does not match the size of its image!".format(path))
+    shutil.copy(path, target)
+
+
+def _blank_mask(target, size):
+    io.imwrite(target, np.zeros(size, dtype=np.uint8))
 
 
 def open_project(archive_path):
-    # Extract all files to a temp dir, which is used as root directory
+    # An append that did not complete is undone, its edits are still in the journal
+    _restore_append(Path(archive_path))
+
+    # Nothing is extracted up front, the temp dir only receives modified files
     temp_dir = tempfile.TemporaryDirectory(prefix="segmate-")
     with zipfile.ZipFile(archive_path, mode="r") as zipf:
-        zipf.extractall(path=temp_dir.name)
-    with open(Path(temp_dir.name) / "meta") as jf:
-        json_data = json.load(jf)
-    return Project(temp_dir, Path(archive_path), Path(temp_dir.name) / "data",
-        json_data["version"], json_data["layers"], json_data["masks"], json_data["colors"])
-
-
-def write_project(project):
-    # Add all files in temp dir to a new zip archive
-    temp_path = Path(project.temp_dir.name)
-    files = [f for f in temp_path.rglob("*") if f.is_file()]
-    modified_path = temp_path / project.archive_path.name
+        json_data = json.loads(zipf.read("meta").decode("utf-8"))
+    data_root = Path(temp_dir.name) / "data"
+    makedirs(data_root)
+    project = Project(temp_dir, Path(archive_path), data_root, json_data["version"],
+        json_data["layers"], json_data["masks"], json_data["colors"])
+    project.archive.open()
+    project.recovered = project.journal.replay()
+    return project
+
+
+def write_project(project, *, compact=False, allow_compact=True):
+    # allow_compact=False always appends to an existing archive, the file is only
+    # extended then, which keeps memory maps of other processes valid
+    archive = project.archive
+    if not archive.exists or compact:
+        _rewrite_project(project)
+    elif allow_compact and archive.garbage_bytes > COMPACTION_THRESHOLD * archive.size:
+        _rewrite_project(project)
+    else:
+        _append_project(project)
+    # All edits are part of the archive now, so the journal is obsolete
+    project.journal.clear()
+
+
+def _append_project(project):
+    # Append the modified files to the existing archive, this leaves all other
+    # members untouched. Only the central directory at the end is rewritten.
+    overlays = [f for f in project.data_root.rglob("*") if f.is_file()]
+    if not overlays:
+        return
+
+    # The new members are written over the old central directory, hence it is
+    # backed up first and put back if the append fails
+    backup = _backup_append(project.archive_path, project.archive.central_directory_offset)
+    with project.archive.suspended():
+        try:
+            with warnings.catch_warnings():
+                # Shadowing an existing member is intended, do not warn about it
+                warnings.simplefilter("ignore", UserWarning)
+                with zipfile.ZipFile(project.archive_path, mode="a",
+                        compression=zipfile.ZIP_STORED) as zipf:
+                    for path in overlays:
+                        zipf.write(path, arcname="data/{0}".format(
+                            path.relative_to(project.data_root).as_posix()))
+            _sync(project.archive_path)
+        except BaseException:
+            _restore_append(project.archive_path)
+            raise
+    # The archive was opened again successfully, so the append is complete
+    backup.unlink()
+
+    for path in overlays:
+        path.unlink()
+
+
+def _backup_append(archive_path, offset):
+    backup = Path(str(archive_path) + APPEND_BACKUP_SUFFIX)
+    with open(archive_path, "rb") as f:
+        f.seek(offset)
+        tail = f.read()
+    with open(backup, "wb") as f:
+        f.write(struct.pack("<Q", offset))
+        f.write(tail)
+        f.flush()
+        os.fsync(f.fileno())
+    return backup
+
+
+def _restore_append(archive_path):
+    backup = Path(str(archive_path) + APPEND_BACKUP_SUFFIX)
+    if not backup.is_file():
+        return
+    data = backup.read_bytes()
+    offset, = struct.unpack("<Q", data[:8])
+    with open(archive_path, "r+b") as f:
+        f.seek(offset)
+        f.write(data[8:])
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+    backup.unlink()
+
+
+def _sync(path):
+    # Windows can only flush a descriptor that was opened for writing
+    with open(path, "r+b") as f:
+        os.fsync(f.fileno())
+
+
+def _rewrite_project(project):
+    # Write unmodified members of the current archive and all modified files in the
+    # temp dir to a new zip archive
+    # The new archive is written next to the original, so that it can replace it
+    # atomically; a crash while writing leaves the original untouched
+    modified_path = project.archive_path.with_name(project.archive_path.name + ".tmp")
+    archive = project.archive
+    overlays = [f for f in project.data_root.rglob("*") if f.is_file()]
+    overlaid = {"data/{0}".format(f.relative_to(project.data_root).as_posix())
+        for f in overlays}
+
     with zipfile.ZipFile(modified_path, mode="w", compression=zipfile.ZIP_STORED) as zipf:
-        for path in files:
-            zipf.write(path, arcname=path.relative_to(temp_path))
+        zipf.writestr("meta", json.dumps(project.meta))
+        for member in archive.members():
+            if member == "meta" or member in overlaid:
+                continue
+            zipf.writestr(member, archive.read_member(member))
+        for path in overlays:
+            zipf.write(path, arcname="data/{0}".format(
+                path.relative_to(project.data_root).as_posix()))
+    _sync(modified_path)
+
+    # Processes that still have the original archive mapped keep reading it
+    with archive.suspended():
+        os.replace(str(modified_path), str(project.archive_path))
 
-    # Unconditionally overwrite the original archive. The replace method on a path
-    # object crashes with an 'OSError: [Errno 18] Invalid cross-device link:', when
-    # source and target filesystems are different, hence use shutil instead
-    shutil.move(modified_path, project.archive_path)
+    # Everything is part of the archive now, the modified files are not needed anymore
+    for path in overlays:
+        path.unlink()
 
 
-def export_project(project, path):
-    # Create new folder at path with the archive name and copy the whole temporary
-    # directory to this new folder. If the target already exists it is overwritten.
-    source = Path(project.temp_dir.name) / "data"
+def export_project(project, path, *, incremental=True):
+    # Write all data files of the project to a folder at path with the archive name.
+    # An existing export is synced, only files that differ from the project are
+    # written and files that are not part of the project anymore are removed.
     target = Path(path) / project.archive_path.stem
-    try:
-        shutil.copytree(source, target)
-    except FileExistsError:
+    if target.exists() and not incremental:
         shutil.rmtree(target)
-        shutil.copytree(source, target)
+    manifest_path = target / EXPORT_MANIFEST
+    manifest = {}
+    if manifest_path.is_file():
+        try:
+            manifest = json.loads(manifest_path.read_text())
+        except ValueError:
+            manifest = {}
+
+    exported = {}
+    for folder in project.layers:
+        makedirs(target / folder, exist_ok=True)
+        for name in project.archive.files(folder):
+            relpath = "{0}/{1}".format(folder, name)
+            crc, size = project.archive.checksum(folder, name)
+            if not _is_exported(target / folder / name, crc, size, manifest.get(relpath)):
+                project.archive.copy(folder, name, target / folder / name)
+            stat = (target / folder / name).stat()
+            exported[relpath] = [crc, size, stat.st_mtime_ns]
+
+    for file in [f for f in target.rglob("*") if f.is_file()]:
+        if file != manifest_path and file.relative_to(target).as_posix() not in exported:
+            file.unlink()
+    for folder in sorted((d for d in target.rglob("*") if d.is_dir()), reverse=True):
+        if not any(folder.iterdir()):
+            folder.rmdir()
+    manifest_path.write_text(json.dumps(exported))
+
+
+def _is_exported(path, crc, size, entry):
+    if not path.is_file():
+        return False
+    stat = path.stat()
+    if stat.st_size != size:
+        return False
+    # Trust the manifest as long as the file was not touched since the last export,
+    # otherwise fall back to comparing the checksum of its content
+    if entry == [crc, size, stat.st_mtime_ns]:
+        return True
+    return zlib.crc32(path.read_bytes()) == crc
@@ -58,3 +58,38 @@ def set_last_opened_image(index):
     config.beginGroup("Project")
     config.setValue("last_opened_image", index)
     config.endGroup()
+
+
+def cache_size():
+    config = QSettings("justacid", "Segmate")
+    config.beginGroup("DataStore")
+    size = config.value("cache_size", 2 * 1024**3)
+    config.endGroup()
+    return int(size)
+
+
+def set_cache_size(size):
+    config = QSettings("justacid", "Segmate")
+    config.beginGroup("DataStore")
+    config.setValue("cache_size", size)
+    config.endGroup()
+
+
+def dependency_cache():
+    config = QSettings("justacid", "Segmate")
+    config.beginGroup("Plugins")
+    key = config.value("dependency_key", "")
+    missing = config.value("missing_dependencies", [])
+    config.endGroup()
+    # QSettings returns a single string for lists with one element
+    if isinstance(missing, str):
+        missing = [missing]
+    return key, list(missing or [])
+
+
+def set_dependency_cache(key, missing):
+    config = QSettings("justacid", "Segmate")
+    config.beginGroup("Plugins")
+    config.setValue("dependency_key", key)
+    config.setValue("missing_dependencies", missing)
+    config.endGroup()
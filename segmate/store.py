@@ -1,93 +1,341 @@
-from os import listdir
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, as_completed
+from io import BytesIO
+from os import cpu_count, listdir
 from pathlib import Path
+import threading
 
 import imageio as io
 import numpy as np
-import skimage.color as skcolor
 from natsort import natsorted, ns
+from PIL import Image
+
+from . import util
+from .cache import ImageCache
+from .lazy import lazy_import
+from .tiles import TiledImage, TILE_THRESHOLD
+
+skcolor = lazy_import("skimage.color")
 
 
 class DataStore:
 
     def __init__(self, **kwargs):
         self._modified = set()
-        self._cache = {}
+        self._cache = ImageCache(
+            kwargs.get("cache_size", 2 * 1024**3), pinned=self._modified)
+        # Reduced resolution levels of image layers have a cache of their own, so
+        # they neither evict decoded images nor count towards their statistics
+        self._pyramids = ImageCache(kwargs.get("pyramid_cache_size", 256 * 1024**2))
+
+        # Neighbouring images are decoded ahead of time on a small thread pool,
+        # the direction of the prefetch follows the most recent navigation
+        self.prefetch_count = kwargs.get("prefetch_count", 2)
+        self._executor = None
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._last_index = None
 
         self.root = kwargs.get("data_root", None)
         self.folders = kwargs.get("folders", None)
         self.masks = kwargs.get("masks", None)
         self.colors = kwargs.get("colors", None)
+        self.archive = kwargs.get("archive", None)
+        self.journal = kwargs.get("journal", None)
+        # Very large layers are converted to tiled images stored below tile_root,
+        # no layer is tiled if it is not set
+        self.tile_root = kwargs.get("tile_root", None)
+        self.tile_threshold = kwargs.get("tile_threshold", TILE_THRESHOLD)
+        self.recovered = 0
         self.files = None
 
-        if self.root and self.folders:
+        if self.archive is not None and self.folders:
+            self.root = Path(self.root)
+            self.files = natsorted(self.archive.files(self.folders[0]), alg=ns.PATH)
+        elif self.root and self.folders:
             self.root = Path(self.root)
             self.files = natsorted(listdir(Path(self.root) / self.folders[0]), alg=ns.PATH)
 
     @classmethod
-    def from_project(cls, project):
+    def from_project(cls, project, **kwargs):
         store = DataStore(
             data_root=project.data_root,
             folders=project.layers,
             masks=project.masks,
-            colors=project.colors
+            colors=project.colors,
+            archive=project.archive,
+            journal=project.journal,
+            tile_root=Path(project.temp_dir.name),
+            **kwargs
         )
+        if project.recovered:
+            store._recover(project.recovered)
         return store
 
     @property
     def num_layers(self):
         return len(self.folders)
 
-    def save_to_disk(self):
-        for idx in self._modified:
-            for i, layer in enumerate(self._cache[idx]):
-                if not self.masks[i]:
-                    continue
-                layer = self._binarize(layer)
-                io.imsave(self.root / self.folders[i] / self.files[idx], layer)
+    @property
+    def cache_info(self):
+        return {
+            "hits": self._cache.hits,
+            "misses": self._cache.misses,
+            "hit_rate": self._cache.hit_rate,
+            "resident_bytes": self._cache.nbytes,
+            "max_bytes": self._cache.max_bytes,
+            "entries": len(self._cache),
+            "pyramid_hit_rate": self._pyramids.hit_rate,
+            "pyramid_bytes": self._pyramids.nbytes
+        }
+
+    def _recover(self, masks):
+        # Apply masks replayed from the edit journal as unsaved modifications
+        indices = {name: i for i, name in enumerate(self.files)}
+        recovered = set()
+        for (folder, name), mask in masks.items():
+            if folder not in self.folders or name not in indices:
+                continue
+            idx, layer_idx = indices[name], self.folders.index(folder)
+            data = list(self[idx])
+            if data[layer_idx].shape != mask.shape:
+                continue
+            data[layer_idx] = mask
+            self[idx] = data
+            recovered.add(idx)
+        self.recovered = len(recovered)
+
+    def pyramid(self, idx, layer_idx):
+        # Reduced resolution levels of an image layer for zoomed out painting. They
+        # are built from the full resolution image, which is decoded for editing
+        # anyway, this only saves converting and scaling it on every repaint.
+        levels = self._pyramids.get((idx, layer_idx))
+        if levels is not None:
+            return levels
+        data = self._cache.peek(idx)
+        image = (data if data is not None else self[idx])[layer_idx]
+        if isinstance(image, TiledImage):
+            return []
+        return self._pyramids.setdefault((idx, layer_idx), util.pyramid.build(image)[1:])
+
+    def prefetch(self, idx):
+        if self.prefetch_count <= 0 or not self.files:
+            return
+
+        direction = -1 if self._last_index is not None and idx < self._last_index else 1
+        self._last_index = idx
+        ahead = [idx + direction * i for i in range(1, self.prefetch_count + 1)]
+        wanted = [i for i in ahead + [idx - direction] if 0 <= i < len(self.files)]
+
+        with self._pending_lock:
+            # Requests that fell out of the window are dropped, unless already running
+            for i, future in list(self._pending.items()):
+                if i not in wanted and future.cancel():
+                    del self._pending[i]
+            for i in wanted:
+                if i not in self._cache:
+                    self._submit(i)
+
+    def request(self, idx):
+        assert idx >= 0 and idx < len(self.files)
+        data = self._cache.get(idx)
+        if data is not None:
+            future = Future()
+            future.set_result(data)
+            return future
+
+        with self._pending_lock:
+            return self._submit(idx)
+
+    def cancel(self, idx):
+        with self._pending_lock:
+            future = self._pending.get(idx)
+            if future is not None and future.cancel():
+                del self._pending[idx]
+
+    def is_cached(self, idx):
+        return idx in self._cache
+
+    def discard(self, idx):
+        # Drops the decoded data, e.g. after the files were changed on disk
+        if idx not in self._modified:
+            self._cache.discard(idx)
+
+    def mask_source(self, idx, layer_idx):
+        return self._read_path(idx, self.folders[layer_idx])
+
+    def mask_target(self, idx, layer_idx):
+        return self._write_path(idx, self.folders[layer_idx])
+
+    def close(self):
+        with self._pending_lock:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _submit(self, idx):
+        # Must be called while holding the pending lock
+        if idx in self._pending:
+            return self._pending[idx]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=max(1, self.prefetch_count))
+        self._pending[idx] = self._executor.submit(self._prefetch_worker, idx)
+        return self._pending[idx]
+
+    def _prefetch_worker(self, idx):
+        try:
+            # Never overwrite an entry that was loaded or modified in the meantime
+            return self._cache.setdefault(idx, self._load(idx))
+        finally:
+            with self._pending_lock:
+                self._pending.pop(idx, None)
+
+    def save_to_disk(self, progress=None):
+        jobs = []
+        for idx in sorted(self._modified):
+            for i, layer in enumerate(self._cache.peek(idx)):
+                if self.masks[i]:
+                    jobs.append((idx, i, layer))
+
+        # Encoding (deflate) releases the GIL, so a thread pool suffices; progress
+        # is reported from the calling thread as (saved, total)
+        if jobs:
+            with ThreadPoolExecutor(max_workers=cpu_count() or 1) as pool:
+                futures = [pool.submit(self._save_mask, *job) for job in jobs]
+                for done, future in enumerate(as_completed(futures), 1):
+                    future.result()
+                    if progress is not None:
+                        progress(done, len(jobs))
+
+        # Saved entries are no longer pinned, so they may now be evicted
         self._modified.clear()
+        self._cache.evict()
 
-    def _binarize(self, image):
-        image = skcolor.rgb2gray(image[:, :, :3])
-        output = np.zeros(image.shape, dtype=np.uint8)
-        output[image != 0.0] = 255
+    def _save_mask(self, idx, layer_idx, mask):
+        path = self._write_path(idx, self.folders[layer_idx])
+        if isinstance(mask, TiledImage):
+            mask.flush()
+            if path.suffix.lower() == ".png":
+                # Written band by band, only one row of tiles is held at a time
+                util.png.write_gray(path, mask.shape[:2],
+                    (self._binarize(band) for band in mask.bands()))
+            else:
+                # imageio can only write other formats as a whole
+                io.imsave(path, self._binarize(mask.to_array()))
+            return
+        io.imsave(path, self._binarize(mask))
+
+    def _binarize(self, mask):
+        if len(mask.shape) == 3:
+            # A colored mask, the alpha channel marks the foreground
+            mask = mask[:, :, 3] if mask.shape[2] == 4 else mask.max(axis=2)
+        output = np.zeros(mask.shape, dtype=np.uint8)
+        output[mask != 0] = 255
         return output
 
-    def _load_image(self, idx, folder):
-        path = self.root / folder / self.files[idx]
-        image = io.imread(path)
+    def _load(self, idx):
+        data = []
+        for i, folder in enumerate(self.folders):
+            source = self._read_path(idx, folder)
+            if self._is_large(source):
+                data.append(self._load_tiled(source, self.masks[i]))
+            elif not self.masks[i]:
+                data.append(self._load_image(source))
+            else:
+                data.append(self._load_mask(source))
+        return data
+
+    def _is_large(self, source):
+        # Only the header is read to decide whether a layer is tiled
+        if self.tile_root is None:
+            return False
+        with self._open(source) as image:
+            width, height = image.size
+        return width * height > self.tile_threshold
+
+    def _load_tiled(self, source, is_mask):
+        # PIL decodes the file once in its own pixel format, PNG can not be decoded
+        # in parts. The conversion into the layer format is done tile by tile, so
+        # the decoded image is never copied or converted as a whole.
+        with self._open(source) as image:
+            width, height = image.size
+            def read_tile(rect):
+                (y1, x1), (y2, x2) = rect
+                return self._convert(image.crop((x1, y1, x2, y2)), is_mask)
+            sample = read_tile([(0, 0), (1, 1)])
+            return TiledImage.from_tiles((height, width) + sample.shape[2:], sample.dtype,
+                read_tile, directory=self.tile_root)
+
+    def _open(self, source):
+        return Image.open(BytesIO(source) if isinstance(source, bytes) else source)
+
+    def _convert(self, image, is_mask):
+        # Matches the conversion of _load_mask and _load_image for a part of a file
+        if is_mask:
+            return (np.asarray(image.convert("L")) == 255).astype(np.uint8)
+        if image.mode not in ("L", "RGB", "RGBA"):
+            image = image.convert("RGBA")
+        array = np.asarray(image)
+        if len(array.shape) == 2:
+            array = skcolor.gray2rgb(array, alpha=True)
+        return array
+
+    def _read_path(self, idx, folder):
+        # Either a path or the raw file content read from the project archive
+        if self.archive is not None:
+            return self.archive.read(folder, self.files[idx])
+        return self.root / folder / self.files[idx]
+
+    def _write_path(self, idx, folder):
+        if self.archive is not None:
+            return self.archive.overlay_path(folder, self.files[idx])
+        return self.root / folder / self.files[idx]
+
+    def _load_image(self, source):
+        image = io.imread(source)
         if len(image.shape) == 2:
             image = skcolor.gray2rgb(image, alpha=True)
         return image
 
-    def _load_mask(self, idx, folder, color):
-        path = self.root / folder / self.files[idx]
-        mask = io.imread(path, as_gray=True)
-        return self._make_alpha(mask, color=color)
-
-    def _make_alpha(self, image, color):
-        alpha = np.zeros([*image.shape, 4], dtype=np.uint8)
-        alpha[image == 0, :] = (0, 0, 0, 0)
-        alpha[image == 255, :] = (*color, 255)
-        return alpha
+    def _load_mask(self, source):
+        # Masks are kept as compact label maps (0 = background, 1 = foreground),
+        # they are only colorized when displayed
+        mask = io.imread(source, as_gray=True)
+        return (mask == 255).astype(np.uint8)
 
     def __len__(self):
         return len(self.files)
 
     def __getitem__(self, idx):
         assert idx >= 0 and idx < len(self.files)
-        if idx in self._cache:
-            return self._cache[idx]
+        data = self._cache.get(idx)
+        if data is not None:
+            return data
 
-        data = []
-        for i, folder in enumerate(self.folders):
-            if not self.masks[i]:
-                data.append(self._load_image(idx, self.folders[i]))
-            else:
-                data.append(self._load_mask(idx, folder, color=self.colors[i]))
+        # If the image is currently being prefetched wait for it to finish
+        # instead of decoding the same files a second time
+        with self._pending_lock:
+            future = self._pending.get(idx)
+        if future is not None:
+            try:
+                return future.result()
+            except CancelledError:
+                pass
+            except Exception:
+                # A failed prefetch, e.g. while the project was saved, is not
+                # reported here - decoding again below raises a persistent error
+                pass
 
-        self._cache[idx] = data
-        return data
+        return self._cache.setdefault(idx, self._load(idx))
 
     def __setitem__(self, idx, value):
-        self._cache[idx] = value
+        # Pin before inserting, otherwise the entry might be evicted right away
         self._modified.add(idx)
+        self._cache.put(idx, value)
+        if self.journal is not None:
+            for i, layer in enumerate(value):
+                # Tiled layers are too large to be journaled as a whole
+                if self.masks[i] and not isinstance(layer, TiledImage):
+                    self.journal.record(self.folders[i], self.files[idx], layer)
@@ -0,0 +1,157 @@
+import os
+from pathlib import Path
+import tempfile
+import threading
+import weakref
+
+import numpy as np
+
+from .cache import ImageCache
+
+
+# Edge length of the square tiles, tiles at the right and bottom border are
+# stored padded to the full size, so every tile occupies a chunk of equal size
+TILE_SIZE = 512
+
+# Layers of images with more pixels than this are stored tiled by the data store
+TILE_THRESHOLD = 128 * 1024**2
+
+
+class TiledImage:
+    """
+    Image split into fixed-size tiles, which are stored as chunks of a file on
+    disk. Only tiles that are accessed are read, they are kept in a bounded cache.
+    Modified tiles stay in the cache until they are written back by flush, hence
+    memory use depends on the visited and edited region, not on the image size.
+    """
+
+    def __init__(self, path, shape, dtype, *, tile_size=TILE_SIZE, cache_size=128 * 1024**2):
+        self.path = Path(path)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.tile_size = tile_size
+        self.grid = (-(-self.shape[0] // tile_size), -(-self.shape[1] // tile_size))
+
+        chunk_shape = self.grid + (tile_size, tile_size) + self.shape[2:]
+        self._chunks = np.memmap(self.path, dtype=self.dtype, mode="w+", shape=chunk_shape)
+        self._dirty = set()
+        self._versions = {}
+        self._cache = ImageCache(cache_size, pinned=self._dirty)
+        self._lock = threading.RLock()
+        self._finalizer = weakref.finalize(self, _remove, self.path)
+
+    @classmethod
+    def from_array(cls, array, *, directory=None, **kwargs):
+        return cls.from_tiles(array.shape, array.dtype,
+            lambda rect: array[rect[0][0]:rect[1][0], rect[0][1]:rect[1][1]],
+            directory=directory, **kwargs)
+
+    @classmethod
+    def from_tiles(cls, shape, dtype, read_tile, *, directory=None, **kwargs):
+        # read_tile is called with the rect of every tile and returns its pixels,
+        # tiles go straight to the file, so the image is never held as a whole
+        handle, path = tempfile.mkstemp(suffix=".tiles", dir=directory)
+        os.close(handle)
+        image = cls(path, shape, dtype, **kwargs)
+        for ty in range(image.grid[0]):
+            for tx in range(image.grid[1]):
+                tile = read_tile(image.tile_rect(ty, tx))
+                image._chunks[ty, tx, :tile.shape[0], :tile.shape[1]] = tile
+        image._chunks.flush()
+        return image
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        # Only the tiles held in memory count, the rest of the image is on disk
+        return self._cache.nbytes
+
+    def tile(self, ty, tx):
+        """Returns the tile as a writable view, use write to mark changes."""
+        with self._lock:
+            entry = self._cache.get((ty, tx))
+            if entry is None:
+                entry = (np.array(self._chunks[ty, tx]),)
+                self._cache.put((ty, tx), entry)
+        (y1, x1), (y2, x2) = self.tile_rect(ty, tx)
+        return entry[0][:y2 - y1, :x2 - x1]
+
+    def tile_rect(self, ty, tx):
+        t = self.tile_size
+        y1, x1 = ty * t, tx * t
+        return [(y1, x1), (min(y1 + t, self.shape[0]), min(x1 + t, self.shape[1]))]
+
+    def version(self, ty, tx):
+        return self._versions.get((ty, tx), 0)
+
+    def tiles_in(self, rect):
+        (y1, x1), (y2, x2) = self._clip(rect)
+        if y2 <= y1 or x2 <= x1:
+            return []
+        t = self.tile_size
+        return [(ty, tx) for ty in range(y1 // t, (y2 - 1) // t + 1)
+            for tx in range(x1 // t, (x2 - 1) // t + 1)]
+
+    def read(self, rect):
+        (y1, x1), (y2, x2) = self._clip(rect)
+        output = np.zeros((max(y2 - y1, 0), max(x2 - x1, 0)) + self.shape[2:], self.dtype)
+        for ty, tx in self.tiles_in(rect):
+            (ty1, tx1), (ty2, tx2) = self.tile_rect(ty, tx)
+            sy1, sx1, sy2, sx2 = max(y1, ty1), max(x1, tx1), min(y2, ty2), min(x2, tx2)
+            output[sy1 - y1:sy2 - y1, sx1 - x1:sx2 - x1] = \
+                self.tile(ty, tx)[sy1 - ty1:sy2 - ty1, sx1 - tx1:sx2 - tx1]
+        return output
+
+    def write(self, origin, region):
+        y1, x1 = int(origin[0]), int(origin[1])
+        rect = [(y1, x1), (y1 + region.shape[0], x1 + region.shape[1])]
+        (cy1, cx1), (cy2, cx2) = self._clip(rect)
+        with self._lock:
+            for ty, tx in self.tiles_in(rect):
+                (ty1, tx1), (ty2, tx2) = self.tile_rect(ty, tx)
+                sy1, sx1 = max(cy1, ty1), max(cx1, tx1)
+                sy2, sx2 = min(cy2, ty2), min(cx2, tx2)
+                # Pin the tile before it is modified, so that it can not be evicted
+                self._dirty.add((ty, tx))
+                self.tile(ty, tx)[sy1 - ty1:sy2 - ty1, sx1 - tx1:sx2 - tx1] = \
+                    region[sy1 - y1:sy2 - y1, sx1 - x1:sx2 - x1]
+                self._versions[(ty, tx)] = self.version(ty, tx) + 1
+
+    def flush(self):
+        with self._lock:
+            for key in list(self._dirty):
+                self._chunks[key] = self._cache.peek(key)[0]
+            self._chunks.flush()
+            self._dirty.clear()
+            self._cache.evict()
+
+    def to_array(self):
+        return self.read([(0, 0), self.shape[:2]])
+
+    def bands(self):
+        """Yields the image as consecutive bands of full rows, one row of tiles each."""
+        for ty in range(self.grid[0]):
+            (y1, _), (y2, _) = self.tile_rect(ty, 0)
+            yield self.read([(y1, 0), (y2, self.shape[1])])
+
+    def close(self):
+        self._chunks = None
+        self._cache.clear()
+        self._finalizer()
+
+    def _clip(self, rect):
+        h, w = self.shape[:2]
+        y1, x1 = max(int(rect[0][0]), 0), max(int(rect[0][1]), 0)
+        y2, x2 = min(int(rect[1][0]), h), min(int(rect[1][1]), w)
+        return [(y1, x1), (y2, x2)]
+
+
+def _remove(path):
+    # The backing file only lives as long as the image object
+    try:
+        path.unlink()
+    except OSError:
+        pass
@@ -1,3 +1,5 @@
 from . import draw
 from . import mask
-from .qimage import to_qimage, from_qimage
+from . import png
+from . import pyramid
+from .qimage import to_qimage, from_qimage, color_table
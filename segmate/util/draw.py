@@ -1,9 +1,14 @@
+import functools
+
 import numpy as np
-import skimage.draw as draw
-import skimage.measure as measure
-import skimage.color as skcolor
 
 import segmate.util as util
+from ..lazy import lazy_import
+
+ndi = lazy_import("scipy.ndimage")
+draw = lazy_import("skimage.draw")
+measure = lazy_import("skimage.measure")
+skcolor = lazy_import("skimage.color")
 
 
 def line(image, p0, p1, color, *, width=1):
@@ -15,6 +20,9 @@ def line(image, p0, p1, color, *, width=1):
         p1: End point
         color: Color of the drawn line
         width: The thickness of the line
+
+    Returns:
+        Bounding box [(y1, x1), (y2, x2)] of the modified pixels, end exclusive
     """
     r0, c0 = int(p0[0]), int(p0[1])
     r1, c1 = int(p1[0]), int(p1[1])
@@ -22,17 +30,32 @@ def line(image, p0, p1, color, *, width=1):
     rows, cols = draw.line(r0, c0, r1, c1)
     rows = np.clip(rows, 0, image.shape[0]-1)
     cols = np.clip(cols, 0, image.shape[1]-1)
-    image[rows, cols] = color
-    radius = width / 2
 
-    for row, col in zip(rows, cols):
-        if width % 2 != 0:
-            rr, cc = draw.circle(row, col, radius)
-        else:
-            rr, cc = draw.circle(row + 0.5, col + 0.5, radius)
-        rr = np.clip(rr, 0, image.shape[0]-1)
-        cc = np.clip(cc, 0, image.shape[1]-1)
-        image[rr, cc] = color
+    # Stamp the brush onto every pixel of the line at once, pixels outside of
+    # the image are clamped to the border
+    brush_rows, brush_cols = _brush(width)
+    rr = np.clip(rows[:, None] + brush_rows[None, :], 0, image.shape[0]-1)
+    cc = np.clip(cols[:, None] + brush_cols[None, :], 0, image.shape[1]-1)
+    rr = np.concatenate([rows, rr.ravel()])
+    cc = np.concatenate([cols, cc.ravel()])
+
+    y1, x1 = rr.min(), cc.min()
+    y2, x2 = rr.max() + 1, cc.max() + 1
+    stamp = np.zeros((y2 - y1, x2 - x1), dtype=np.bool_)
+    stamp[rr - y1, cc - x1] = True
+    image[y1:y2, x1:x2][stamp] = color
+    return [(y1, x1), (y2, x2)]
+
+
+@functools.lru_cache(maxsize=None)
+def _brush(width):
+    # Offsets of the circular brush footprint relative to the center pixel
+    radius = width / 2
+    if width % 2 != 0:
+        rr, cc = draw.circle(0, 0, radius)
+    else:
+        rr, cc = draw.circle(0.5, 0.5, radius)
+    return rr.astype(np.intp), cc.astype(np.intp)
 
 
 def rectangle(image, top_left, bot_right, color):
@@ -58,26 +81,37 @@ def flood_fill(image, seed, fill_color, *, border_color=None):
         image: The canvas to draw on
         seed: Seed point for the flood fill
         color: Color of the filled region
+
+    Returns:
+        Bounding box [(y1, x1), (y2, x2)] of the filled region, end exclusive
     """
 
     if border_color is None:
         border_color = fill_color
 
-    h, w = image.shape[:2]
-    coords = [[int(c) for c in seed]]
-
-    while coords:
-        y, x = coords.pop()
-        image[y, x] = fill_color
-
-        if y + 1 < h and not np.array_equal(image[y + 1, x], border_color):
-            coords.append([y + 1, x])
-        if y - 1 >= 0 and not np.array_equal(image[y - 1, x], border_color):
-            coords.append([y - 1, x])
-        if x + 1 < w and not np.array_equal(image[y, x + 1], border_color):
-            coords.append([y, x + 1])
-        if x - 1 >= 0 and not np.array_equal(image[y, x - 1], border_color):
-            coords.append([y, x - 1])
+    # The filled region is the 4-connected component of non-border pixels that
+    # contains the seed, found by labelling instead of visiting every pixel
+    y, x = [int(c) for c in seed]
+    passable = image != np.asarray(border_color)
+    if passable.ndim > 2:
+        passable = passable.any(axis=-1)
+    labels, _ = ndi.label(passable)
+
+    if passable[y, x]:
+        region = labels == labels[y, x]
+    else:
+        # A seed on the border color is filled itself and spreads to its neighbors
+        h, w = labels.shape
+        neighbors = [(y + 1, x), (y - 1, x), (y, x + 1), (y, x - 1)]
+        ids = [labels[r, c] for r, c in neighbors if 0 <= r < h and 0 <= c < w]
+        region = np.isin(labels, [i for i in ids if i != 0])
+        region[y, x] = True
+
+    rows = np.flatnonzero(region.any(axis=1))
+    cols = np.flatnonzero(region.any(axis=0))
+    y1, y2, x1, x2 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    image[y1:y2, x1:x2][region[y1:y2, x1:x2]] = fill_color
+    return [(y1, x1), (y2, x2)]
 
 
 def contours(dest, source, color):
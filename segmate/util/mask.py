@@ -1,8 +1,11 @@
 import warnings
 
 import numpy as np
-import skimage
-import skimage.color as skcolor
+
+from ..lazy import lazy_import
+
+skimage = lazy_import("skimage")
+skcolor = lazy_import("skimage.color")
 
 
 def binary(array):
@@ -24,6 +27,22 @@ def binary(array):
     return array != 0.0
 
 
+def compact(array):
+    """Returns the compact label map of a mask, as used internally for mask layers.
+
+    Args:
+        array: A binary mask, a label map or a colored RGB(A) mask
+
+    Returns:
+        Numpy array of type uint8 and shape [H, W], where the foreground is 1
+    """
+    if array is None:
+        raise ValueError("The argument 'array' can not be 'None'.")
+    if len(array.shape) == 2 and array.dtype == np.uint8 and array.max(initial=0) <= 1:
+        return array
+    return binary(array).astype(np.uint8)
+
+
 def color(array, color=(255, 255, 255)):
     """Returns a colored numpy array from a binary mask with given color.
 
@@ -0,0 +1,50 @@
+import struct
+import zlib
+
+import numpy as np
+
+
+SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def write_gray(path, shape, bands, *, level=6):
+    """Write an 8 bit grayscale PNG from consecutive bands of rows.
+
+    Rows are compressed as they arrive, so the image never has to be held in
+    memory as a whole, unlike with the writers of imageio.
+
+    Args:
+        path: Path of the file to write
+        shape: Height and width of the image
+        bands: Iterable of uint8 numpy arrays with shape [rows, width], which
+            together cover the image from top to bottom
+        level: zlib compression level
+    """
+    height, width = shape
+    compressor = zlib.compressobj(level)
+    written = 0
+    with open(path, "wb") as f:
+        f.write(SIGNATURE)
+        _write_chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+        for band in bands:
+            if band.shape[1:] != (width,):
+                raise ValueError("Band of shape {0} does not match width {1}.".format(
+                    band.shape, width))
+            # Every row starts with its filter type, 0 leaves the row as it is
+            rows = np.zeros((band.shape[0], width + 1), dtype=np.uint8)
+            rows[:, 1:] = band
+            _write_chunk(f, b"IDAT", compressor.compress(rows.tobytes()))
+            written += band.shape[0]
+        if written != height:
+            raise ValueError("Bands cover {0} rows instead of {1}.".format(written, height))
+        _write_chunk(f, b"IDAT", compressor.flush())
+        _write_chunk(f, b"IEND", b"")
+
+
+def _write_chunk(f, kind, data):
+    if not data and kind == b"IDAT":
+        return
+    f.write(struct.pack(">I", len(data)))
+    f.write(kind)
+    f.write(data)
+    f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind)) & 0xffffffff))
@@ -0,0 +1,95 @@
+import numpy as np
+
+
+# Levels are only built as long as the image does not fit into this size
+MIN_LEVEL_SIZE = 256
+
+
+def downsample(array, *, mode="mean"):
+    """Halve the resolution of an image by reducing blocks of 2x2 pixels.
+
+    Args:
+        array: A numpy array with shape [H, W] or [H, W, C]
+        mode: 'mean' averages each block (images), 'max' keeps the largest value
+            of each block, so that thin structures of masks do not disappear
+
+    Returns:
+        Numpy array with shape [ceil(H/2), ceil(W/2)] (and C) of the same type
+    """
+    if array is None:
+        raise ValueError("The argument 'array' can not be 'None'.")
+    if mode not in ("mean", "max"):
+        raise ValueError("Unsupported mode '{0}'.".format(mode))
+
+    # Odd sizes are padded by repeating the last row or column
+    h, w = array.shape[:2]
+    if h % 2 or w % 2:
+        padding = [(0, h % 2), (0, w % 2)] + [(0, 0)] * (array.ndim - 2)
+        array = np.pad(array, padding, mode="edge")
+
+    blocks = array.reshape(
+        array.shape[0] // 2, 2, array.shape[1] // 2, 2, *array.shape[2:])
+    if mode == "max":
+        return blocks.max(axis=(1, 3))
+    result = blocks.mean(axis=(1, 3), dtype=np.float32)
+    if np.issubdtype(array.dtype, np.integer):
+        result = np.rint(result)
+    return result.astype(array.dtype)
+
+
+def build(array, *, mode="mean", min_size=MIN_LEVEL_SIZE):
+    """Build a mip pyramid of an image.
+
+    Args:
+        array: A numpy array with shape [H, W] or [H, W, C]
+        mode: How blocks of pixels are reduced, see downsample
+        min_size: No further level is built once the image fits this size
+
+    Returns:
+        List of levels, the first entry is the array itself and every following
+        level has half the resolution of the previous one
+    """
+    levels = [array]
+    while max(levels[-1].shape[:2]) > min_size:
+        levels.append(downsample(levels[-1], mode=mode))
+    return levels
+
+
+def update(levels, rect, *, mode="mean"):
+    """Update a region of all reduced levels after the first level changed.
+
+    Args:
+        levels: A pyramid as returned by build
+        rect: Changed region of the first level as [(y1, x1), (y2, x2)]
+        mode: How blocks of pixels are reduced, see downsample
+    """
+    y1, x1 = int(rect[0][0]), int(rect[0][1])
+    y2, x2 = int(rect[1][0]), int(rect[1][1])
+    for i in range(1, len(levels)):
+        # Align the region to whole blocks of the previous level
+        y1, x1 = max(y1, 0) // 2 * 2, max(x1, 0) // 2 * 2
+        h, w = levels[i - 1].shape[:2]
+        y2, x2 = min(y2 + y2 % 2, h), min(x2 + x2 % 2, w)
+        if y2 <= y1 or x2 <= x1:
+            return
+        region = downsample(levels[i - 1][y1:y2, x1:x2], mode=mode)
+        y1, x1 = y1 // 2, x1 // 2
+        levels[i][y1:y1 + region.shape[0], x1:x1 + region.shape[1]] = region
+        y2, x2 = y1 + region.shape[0], x1 + region.shape[1]
+
+
+def level_for_scale(scale, num_levels):
+    """Returns the smallest level, that still has at least the resolution needed
+    to display an image at the given scale.
+
+    Args:
+        scale: Scale factor of the view, 1.0 displays the image at full resolution
+        num_levels: Number of levels of the pyramid
+
+    Returns:
+        Index of the pyramid level
+    """
+    if scale <= 0.0 or scale >= 1.0:
+        return 0
+    level = int(np.floor(np.log2(1.0 / scale)))
+    return min(level, num_levels - 1)
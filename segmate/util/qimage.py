@@ -1,16 +1,16 @@
 import warnings
 
 import numpy as np
-from PySide2.QtGui import QImage
-from skimage.color import rgb2gray
-from skimage import img_as_ubyte
+from PySide2.QtGui import QImage, qRgba
 
 
-def to_qimage(array):
+def to_qimage(array, *, color_table=None):
     """Convert NumPy array to QImage object
 
     Args:
         arr: A numpy array
+        color_table: Optional list of QRgb values, a two-dimensional array is then
+            interpreted as a label map and colorized with the given colors
 
     Returns:
         An QImage object.
@@ -34,10 +34,26 @@ def to_qimage(array):
     if cdim not in formats:
         raise TypeError("Unsupported image format.")
 
-    qimage = QImage(array.data, *shape, stride, formats[cdim])
+    if cdim == 0 and color_table is not None:
+        qimage = QImage(array.data, *shape, stride, QImage.Format_Indexed8)
+        qimage.setColorTable(color_table)
+    else:
+        qimage = QImage(array.data, *shape, stride, formats[cdim])
     return qimage.convertToFormat(QImage.Format_RGBA8888)
 
 
+def color_table(color):
+    """Color table to display a mask label map with to_qimage.
+
+    Args:
+        color: RGB color of the foreground
+
+    Returns:
+        List of QRgb values, where label 0 is transparent.
+    """
+    return [qRgba(0, 0, 0, 0)] + [qRgba(*color, 255)] * 255
+
+
 def from_qimage(image):
     """Convert QImage object to a numpy array. Always copies.
 
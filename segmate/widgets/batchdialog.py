@@ -0,0 +1,70 @@
+from PySide2.QtCore import *
+from PySide2.QtWidgets import *
+from PySide2.QtGui import *
+
+from .. import batch
+
+
+class BatchDialog(QDialog):
+
+    def __init__(self, layers, masks, image_count, parent=None):
+        super().__init__(parent)
+        self._layers = [i for i, is_mask in enumerate(masks) if is_mask]
+        self._setup_ui(layers, image_count)
+
+    @property
+    def layer(self):
+        return self._layers[self.layer_box.currentIndex()]
+
+    @property
+    def operation(self):
+        return self.operation_box.currentData()
+
+    @property
+    def iterations(self):
+        return self.iterations_box.value()
+
+    @property
+    def indices(self):
+        return range(self.first_box.value() - 1, self.last_box.value())
+
+    def _setup_ui(self, layers, image_count):
+        self.setWindowTitle("Batch Morphology")
+
+        self.layer_box = QComboBox()
+        for i in self._layers:
+            self.layer_box.addItem(layers[i])
+
+        self.operation_box = QComboBox()
+        names = {"fill_holes": "Fill Holes", "dilate": "Dilate", "erode": "Erode",
+            "skeletonize": "Skeletonize"}
+        for operation in batch.OPERATIONS:
+            self.operation_box.addItem(names.get(operation, operation), operation)
+
+        self.iterations_box = QSpinBox()
+        self.iterations_box.setRange(1, 100)
+
+        self.first_box = QSpinBox()
+        self.first_box.setRange(1, image_count)
+        self.first_box.setValue(1)
+        self.last_box = QSpinBox()
+        self.last_box.setRange(1, image_count)
+        self.last_box.setValue(image_count)
+        self.first_box.valueChanged.connect(self.last_box.setMinimum)
+        self.last_box.valueChanged.connect(self.first_box.setMaximum)
+
+        form = QFormLayout()
+        form.addRow("Layer:", self.layer_box)
+        form.addRow("Operation:", self.operation_box)
+        form.addRow("Iterations:", self.iterations_box)
+        form.addRow("First image:", self.first_box)
+        form.addRow("Last image:", self.last_box)
+
+        button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        button_box.accepted.connect(self.accept)
+        button_box.rejected.connect(self.reject)
+        button_box.button(QDialogButtonBox.Ok).setEnabled(bool(self._layers))
+
+        layout = QVBoxLayout(self)
+        layout.addLayout(form)
+        layout.addWidget(button_box)
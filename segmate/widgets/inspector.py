@@ -32,6 +32,7 @@ class InspectorWidget(QWidget):
             self._remove_tool_inspector()
             return
 
+        self.scene.image_loaded.connect(self._image_loaded)
         self._add_layer_widgets()
         self.slider.setValue(0)
         self.slider.setMaximum(self.scene.image_count-1)
@@ -56,10 +57,13 @@ class InspectorWidget(QWidget):
 
     def change_image(self, idx):
         self.current_image = idx
-        active_layer = self.scene.active_layer
-        self.scene.load(idx)
         self.slider_box.setTitle("Image {0}/{1}".format(idx+1, self.scene.image_count))
-        self._activate_layer(active_layer)
+        # The image may still be decoded when this returns, the layer is activated
+        # and listeners are notified once it is shown, see _image_loaded
+        self.scene.load(idx, blocking=False)
+
+    def _image_loaded(self, idx):
+        self._activate_layer(self.scene.active_layer)
         self.image_changed.emit()
 
     def show_tool_inspector(self):
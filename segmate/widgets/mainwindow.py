@@ -5,13 +5,14 @@ from PySide2.QtCore import *
 from PySide2.QtWidgets import *
 from PySide2.QtGui import *
 
-from .. import project, settings, plugins, get_version
+from .. import batch, project, settings, plugins, workers, get_version
 from ..store import DataStore
 from ..editor import EditorScene
 from .inspector import InspectorWidget
 from .sceneview import SceneViewWidget
 from .splitcontainer import SplitContainer
 from .projectdialog import ProjectDialog
+from .batchdialog import BatchDialog
 
 
 class MainWindowWidget(QMainWindow):
@@ -59,15 +60,21 @@ class MainWindowWidget(QMainWindow):
     def _open_project(self, project):
         if project is None:
             return
-        store = DataStore.from_project(project)
+        store = DataStore.from_project(project, cache_size=settings.cache_size())
         self.inspector.set_scene(EditorScene(store))
         self.inspector.scene.image_modified.connect(self._mark_dirty)
+        self.inspector.scene.image_loading.connect(self._image_loading)
         self.inspector.change_image(0)
         self.close_action.setEnabled(True)
         self.export_action.setEnabled(True)
+        self.batch_action.setEnabled(True)
         self._update_title()
         settings.set_last_opened_project(str(project.archive_path))
         settings.set_last_opened_image(0)
+        if store.recovered:
+            self._mark_dirty()
+            self.statusBar().showMessage(
+                "Recovered unsaved edits of {0} image(s)".format(store.recovered))
 
     def _close_project(self):
         if self._project_modified:
@@ -76,20 +83,27 @@ class MainWindowWidget(QMainWindow):
                 return False
             elif value == QMessageBox.Save:
                 self._save_project()
+            elif value == QMessageBox.Discard:
+                self._project.journal.clear()
 
         self._set_tool("cursor_tool")
         self.cursor_tool.setChecked(True)
         self._project_modified = False
 
         if self.view.scene() is not None:
+            workers.cancel(self.view.scene().layers)
+            self.view.scene().data_store.close()
             del self.view.scene().data_store
         self.view.setScene(None)
         self.inspector.set_scene(None)
         self.close_action.setEnabled(False)
         self.export_action.setEnabled(False)
+        self.batch_action.setEnabled(False)
         settings.set_last_opened_project("")
         settings.set_last_opened_image(0)
 
+        if self._project is not None:
+            self._project.close()
         self._project = None
         self._update_title()
         return True
@@ -105,6 +119,44 @@ class MainWindowWidget(QMainWindow):
                 self._save_project()
             project.export_project(self._project, folder)
 
+    def _batch_morphology(self):
+        scene = self.inspector.scene
+        if scene is None:
+            return
+        store = scene.data_store
+        dialog = BatchDialog(store.folders, store.masks, len(store), self)
+        if dialog.exec() != QDialog.Accepted:
+            return
+
+        progress = QProgressDialog("Processing masks...", "Cancel", 0, 0, self)
+        progress.setWindowTitle("Batch Morphology")
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setMinimumDuration(500)
+        def report(done, total):
+            progress.setMaximum(total)
+            progress.setValue(done)
+            QApplication.processEvents()
+            return not progress.wasCanceled()
+        processed, error = None, None
+        try:
+            processed = batch.run(store, dialog.layer, dialog.operation,
+                indices=dialog.indices, iterations=dialog.iterations, progress=report)
+        except RuntimeError as e:
+            error = e
+        finally:
+            progress.close()
+            # Masks processed before a failure were written as well, the undo
+            # history refers to the masks as they were before
+            if processed != []:
+                scene.undo_stack.clear()
+                scene.load(self.inspector.current_image)
+                self._mark_dirty()
+
+        if error is not None:
+            QMessageBox.warning(self, "Batch Morphology", str(error), QMessageBox.Ok)
+        elif processed:
+            self.statusBar().showMessage("Processed {0} image(s)".format(len(processed)))
+
     def _open_project_dialog(self):
         if not self._close_project():
             return
@@ -119,17 +171,25 @@ class MainWindowWidget(QMainWindow):
             self.export_action.setEnabled(True)
 
     def _new_project_dialog(self):
-        def finish(result):
-            if result == QDialog.Rejected:
-                return
+        def create(dialog):
+            # Files are imported while the dialog is still open, so that it can show
+            # the progress and errors can be corrected without starting over. The
+            # current project is only closed once the import succeeded.
+            created = project.new_project(dialog.project_path,
+                dialog.layers, dialog.masks, dialog.files, dialog.colors,
+                progress=dialog.report_progress)
             if not self._close_project():
-                return
-            self._project = project.new_project(dialog.project_path,
-                dialog.layers, dialog.masks, dialog.files, dialog.colors)
+                created.close()
+                return False
+            self._project = created
             self._project_modified = False
             project.write_project(self._project)
+            return True
+        def finish(result):
+            if result == QDialog.Rejected or self._project is None:
+                return
             self._open_project(self._project)
-        dialog = ProjectDialog(self)
+        dialog = ProjectDialog(self, create=create)
         dialog.finished.connect(finish)
         dialog.open()
 
@@ -145,7 +205,15 @@ class MainWindowWidget(QMainWindow):
 
     def _save_project(self):
         if self.inspector.scene:
-            self.inspector.scene.save_to_disk()
+            progress = QProgressDialog("Saving images...", None, 0, 0, self)
+            progress.setWindowTitle("Save Project")
+            progress.setWindowModality(Qt.WindowModal)
+            progress.setMinimumDuration(500)
+            def report(done, total):
+                progress.setMaximum(total)
+                progress.setValue(done)
+            self.inspector.scene.save_to_disk(progress=report)
+            progress.close()
             self._project_modified = False
             self._update_title()
             self.save_action.setEnabled(False)
@@ -167,7 +235,15 @@ class MainWindowWidget(QMainWindow):
         layers = self.view.scene().layers
         callback = lambda msg: self.statusBar().showMessage(msg, 2000)
         layers.panes = self.panes
-        layers.change_tool(tool, status_callback=callback)
+        if not layers.change_tool(tool, status_callback=callback):
+            # The plugin providing the tool could not be loaded
+            self._active_tool = self._recent_tool
+            plugin = plugins.get_plugins().get(tool)
+            if plugin is not None and plugin.error is not None:
+                QMessageBox.warning(self, "Plugin not available", plugin.error, QMessageBox.Ok)
+            else:
+                callback("The tool '{0}' is not available.".format(tool))
+            return
         self.inspector.show_tool_inspector()
         self.view.scene().update()
 
@@ -181,6 +257,9 @@ class MainWindowWidget(QMainWindow):
         self._update_title()
         self.save_action.setEnabled(True)
 
+    def _image_loading(self, idx):
+        self.statusBar().showMessage("Loading image {0}...".format(idx + 1), 2000)
+
     def _zoom_changed(self, zoom):
         self.zoom_submenu.setTitle("Zoom ({0}%)".format(zoom))
         try:
@@ -321,14 +400,26 @@ class MainWindowWidget(QMainWindow):
         self.zoom_submenu.addAction(custom_zoom)
 
         self.tools_menu = self.menuBar().addMenu("&Tools")
+        self.batch_action = QAction("&Batch Morphology...")
+        self.batch_action.triggered.connect(self._batch_morphology)
+        self.batch_action.setEnabled(False)
+        self.tools_menu.addAction(self.batch_action)
+        self.tools_menu.addSeparator()
         if plugins.get_plugins():
             self.plugin_menu = self.menuBar().addMenu("&Plugins")
-            for name, tool in plugins.get_plugins().items():
-                menu_entry, _ = tool
+            for name, plugin in plugins.get_plugins().items():
+                menu_entry = plugin.name
                 if menu_entry is None:
                     menu_entry = name
                 action = self.plugin_menu.addAction(menu_entry)
                 action.triggered.connect(partial(self._set_tool, name))
+            self.plugin_menu.addSeparator()
+            report_action = self.plugin_menu.addAction("Import Times...")
+            report_action.triggered.connect(self._show_plugin_report)
+
+    def _show_plugin_report(self):
+        text = "\n".join(plugins.import_report())
+        QMessageBox.information(self, "Plugin Import Times", text, QMessageBox.Ok)
 
     def _add_tool_bar(self):
         toolbar = super().addToolBar("Tools")
@@ -419,7 +510,12 @@ class MainWindowWidget(QMainWindow):
                 return
             elif value == QMessageBox.Save:
                 self._save_project()
+            elif value == QMessageBox.Discard:
+                self._project.journal.clear()
 
         settings.set_window_position(self)
         settings.set_last_opened_image(self.inspector.current_image)
+        if self._project is not None:
+            self._project.close()
+        workers.shutdown()
         super().closeEvent(event)
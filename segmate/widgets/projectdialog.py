@@ -133,8 +133,9 @@ class FileListDialog(QDialog):
 
 class ProjectDialog(QDialog):
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, *, create=None):
         super().__init__(parent)
+        self._create = create
         self._home = QStandardPaths.standardLocations(QStandardPaths.HomeLocation)[0]
         self._docs = QStandardPaths.standardLocations(QStandardPaths.DocumentsLocation)[0]
         self._color_idx = 0
@@ -199,8 +200,32 @@ class ProjectDialog(QDialog):
             text = "You must import at least one image for the 'image' layer!"
             QMessageBox.warning(self, "No base image imported!", text, QMessageBox.Ok)
             return
+        if self._create is not None:
+            self._set_busy(True)
+            try:
+                created = self._create(self)
+            except (AttributeError, OSError) as error:
+                QMessageBox.warning(self, "Import failed!", str(error), QMessageBox.Ok)
+                return
+            finally:
+                self._set_busy(False)
+            if not created:
+                self.reject()
+                return
         self.accept()
 
+    def report_progress(self, done, total):
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(done)
+        QApplication.processEvents(QEventLoop.ExcludeUserInputEvents)
+
+    def _set_busy(self, busy):
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(busy)
+        self.button_box.setEnabled(not busy)
+        self.table.setEnabled(not busy)
+        QApplication.processEvents(QEventLoop.ExcludeUserInputEvents)
+
     def _new_row(self):
         row_idx = self.table.rowCount()
         self.table.setRowCount(row_idx + 1)
@@ -395,11 +420,15 @@ class ProjectDialog(QDialog):
         new_row_btn.setIcon(QIcon("icons/add.png"))
         new_row_btn.setToolButtonStyle(Qt.ToolButtonTextBesideIcon)
         new_row_btn.clicked.connect(self._new_row)
-        button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
-        button_box.accepted.connect(self._validate)
-        button_box.rejected.connect(self.reject)
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setFormat("Importing files... %v/%m")
+        self.progress_bar.setVisible(False)
+        self.button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        self.button_box.accepted.connect(self._validate)
+        self.button_box.rejected.connect(self.reject)
         layout.addWidget(new_row_btn)
-        layout.addWidget(button_box)
+        layout.addWidget(self.progress_bar)
+        layout.addWidget(self.button_box)
 
     def keyPressEvent(self, event):
         if event.key() == Qt.Key_Enter or event.key() == Qt.Key_Return:
@@ -0,0 +1,252 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from os import cpu_count
+import traceback
+
+import numpy as np
+from PySide2.QtCore import QCoreApplication, QObject, Signal
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Before Python 3.8 arrays are pickled and sent to the workers instead
+    shared_memory = None
+
+
+# Shared memory of finished jobs is kept for later jobs up to this many bytes
+SHARED_MEMORY_RESERVE = 256 * 1024**2
+
+_pool = None
+
+
+class Job:
+    """
+    A function submitted to the worker pool. Once the job is cancelled its result
+    is dropped, a job that is already running still finishes in its worker though.
+    """
+
+    def __init__(self, owner, callback, future, shared):
+        self.owner = owner
+        self.cancelled = False
+        self._callback = callback
+        self._future = future
+        self._shared = shared
+
+    @property
+    def done(self):
+        return self._future.done()
+
+    def cancel(self):
+        self.cancelled = True
+        self._future.cancel()
+
+
+class WorkerPool(QObject):
+    """
+    Persistent pool of worker processes for heavy computations, e.g. the inference
+    of plugin tools, which would otherwise block the GUI thread. Arrays passed to a
+    job are copied into shared memory, instead of being pickled, the worker reads
+    them in place. Segments are reused by later jobs. Results are delivered to the
+    callback of the job on the GUI thread.
+    """
+
+    _job_done = Signal(object)
+
+    def __init__(self, workers=None):
+        super().__init__()
+        # Leave one core to the GUI
+        self._workers = workers or max((cpu_count() or 1) - 1, 1)
+        self._executor = None
+        self._jobs = []
+        self._reserve = []
+        # Emitted from the thread of the executor, hence delivered through the event loop
+        self._job_done.connect(self._finish_job)
+
+    def submit(self, function, *args, callback=None, owner=None, **kwargs):
+        if not _event_loop_running():
+            # Results are delivered through the event loop, without one, e.g. in
+            # headless batch runs, the callback would never be called
+            return self._run_inline(function, args, kwargs, callback, owner)
+        if self._executor is None:
+            # Spawned workers do not inherit the threads and Qt state of the application
+            context = multiprocessing.get_context("spawn")
+            self._executor = ProcessPoolExecutor(max_workers=self._workers, mp_context=context)
+
+        shared = []
+        args = [self._share(arg, shared) for arg in args]
+        kwargs = {key: self._share(value, shared) for key, value in kwargs.items()}
+        try:
+            future = self._executor.submit(_run, function, args, kwargs)
+        except BrokenProcessPool:
+            self._release(shared)
+            self._executor = None
+            raise
+
+        job = Job(owner, callback, future, shared)
+        self._jobs.append(job)
+        future.add_done_callback(lambda _: self._job_done.emit(job))
+        return job
+
+    def cancel(self, owner=None):
+        for job in self._jobs:
+            if owner is None or job.owner is owner:
+                job.cancel()
+
+    def shutdown(self):
+        self.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        for array in self._reserve:
+            array.release()
+        self._reserve = []
+
+    def _run_inline(self, function, args, kwargs, callback, owner):
+        future = Future()
+        job = Job(owner, callback, future, [])
+        try:
+            future.set_result(function(*args, **kwargs))
+        except Exception as e:
+            print("There was an error in a worker job: {0}".format(e))
+            future.set_exception(e)
+            return job
+        if callback is not None:
+            callback(future.result())
+        return job
+
+    def _share(self, value, shared):
+        if shared_memory is None or not isinstance(value, np.ndarray) or value.dtype.hasobject:
+            return value
+        # The smallest reserved segment the array fits in is reused
+        fitting = [a for a in self._reserve if a.size >= value.nbytes]
+        if fitting:
+            array = min(fitting, key=lambda a: a.size)
+            self._reserve.remove(array)
+        else:
+            array = _SharedArray(value.nbytes)
+        array.store(value)
+        shared.append(array)
+        return _SharedDescriptor(array.descriptor)
+
+    def _release(self, shared):
+        self._reserve.extend(shared)
+        shared.clear()
+        # Keep the largest segments, they are the most expensive to create
+        self._reserve.sort(key=lambda a: a.size, reverse=True)
+        total = 0
+        for i, array in enumerate(self._reserve):
+            total += array.size
+            if total > SHARED_MEMORY_RESERVE:
+                for dropped in self._reserve[i:]:
+                    dropped.release()
+                del self._reserve[i:]
+                break
+
+    def _finish_job(self, job):
+        if job not in self._jobs:
+            return
+        self._jobs.remove(job)
+        # The worker is done with the arrays, only now they can be reused
+        self._release(job._shared)
+        if job._future.cancelled():
+            return
+
+        try:
+            result = job._future.result()
+        except BrokenProcessPool:
+            print("A worker process terminated unexpectedly, restarting the pool.")
+            self._executor = None
+            return
+        except Exception as e:
+            print("There was an error in a worker job: {0}".format(e))
+            return
+
+        if not job.cancelled and job._callback is not None:
+            job._callback(result)
+
+
+def _event_loop_running():
+    app = QCoreApplication.instance()
+    return app is not None and app.thread().loopLevel() > 0
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = WorkerPool()
+    return _pool
+
+
+def cancel(owner=None):
+    if _pool is not None:
+        _pool.cancel(owner)
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+
+class _SharedArray:
+
+    def __init__(self, nbytes):
+        self._memory = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        self.size = self._memory.size
+        self.descriptor = None
+
+    def store(self, array):
+        np.ndarray(array.shape, array.dtype, buffer=self._memory.buf)[...] = array
+        self.descriptor = (self._memory.name, array.shape, array.dtype.str)
+
+    def release(self):
+        self._memory.close()
+        self._memory.unlink()
+
+
+class _SharedDescriptor(tuple):
+    pass
+
+
+def _attach(value, memories):
+    if not isinstance(value, _SharedDescriptor):
+        return value
+    name, shape, dtype = value
+    memory = shared_memory.SharedMemory(name=name)
+    memories.append(memory)
+    return np.ndarray(shape, np.dtype(dtype), buffer=memory.buf)
+
+
+def _own(value, attached):
+    # Shared arrays are unmapped after the job, results must not refer to them
+    if isinstance(value, np.ndarray):
+        if any(np.may_share_memory(value, array) for array in attached):
+            return value.copy()
+    elif isinstance(value, (tuple, list)):
+        return type(value)(_own(item, attached) for item in value)
+    return value
+
+
+def _run(function, args, kwargs):
+    # Shared arrays are only valid during the call, functions must not keep them
+    memories, attached = [], []
+    try:
+        args = [_attach(arg, memories) for arg in args]
+        kwargs = {key: _attach(value, memories) for key, value in kwargs.items()}
+        attached = [value for value in args + list(kwargs.values())
+            if isinstance(value, np.ndarray)]
+        return _own(function(*args, **kwargs), attached)
+    except Exception:
+        # Exceptions of plugins might not be picklable, send the traceback instead
+        raise RuntimeError(traceback.format_exc())
+    finally:
+        # Views of the shared arrays must be gone before the memory is unmapped
+        args, kwargs, attached = None, None, None
+        for memory in memories:
+            try:
+                memory.close()
+            except BufferError:
+                # The function kept a view, the memory is unmapped once it is freed
+                pass
@@ -16,6 +16,7 @@ setuptools.setup(
     ],
     include_package_data=True,
     entry_points = {
-        "gui_scripts": ["segmate = segmate.main:main"]
+        "gui_scripts": ["segmate = segmate.main:main"],
+        "console_scripts": ["segmate-headless = segmate.headless:main"]
     }
 )